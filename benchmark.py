@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# __author__ = 'maximus'
+
+""" End-to-end benchmark of -m and -s flows against offline Zabbix stand-in (zabbixstub.py)
+
+    benchmark.py --sizes 10 100 1000 10000 --latency 0.01
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+import ruamel.yaml as yaml3ed
+
+from config import ConfigLoader, ConfigCreate
+from mapping import Phases
+from weathermap import WeathermapCLI, positive_int
+from zabbix import ZabbixRegistry
+from zabbixstub import StubData, StubServer, ZabbixStub
+
+log = logging.getLogger(__name__)
+
+
+class Benchmark(object):
+    map_phases = ('login', 'load', 'fetch', 'build', 'draw', 'encode', 'save', 'upload')
+    scan_phases = ('login', 'scan', 'create', 'merge', 'save')
+
+    def __init__(self, latency=0.0, workers=4, repeat=2, cli=True):
+        self.root_path = str(os.path.dirname(os.path.abspath(__file__)))
+        self.font_path_fn = self.root_path + '/fonts/DejaVuSansMono.ttf'
+        self.icon_path = self.root_path + '/icons'
+        self.latency = latency
+        self.workers = workers
+        self.repeat = repeat
+        self.cli = cli
+
+    def run(self, links):
+        """ Run all flows for map with number of links
+        :return: list of results dict"""
+        results = []
+        data = StubData(links=links, name='bench{}'.format(links))
+        stub = ZabbixStub(data, latency=self.latency)
+        server = StubServer(stub).start()
+        tmp_dir = tempfile.mkdtemp(prefix='weathermap-bench')
+        try:
+            cfg_path = tmp_dir + '/mapcfgs'
+            img_path = tmp_dir + '/mapimgs'
+            os.mkdir(cfg_path)
+            os.mkdir(img_path)
+            map_fn = data.name + '.yaml'
+            self._write_cfg(data.config(server.url), cfg_path + '/' + map_fn)
+
+            for run in range(self.repeat):
+                results.append(self._result(links, '-m', run, stub, self._map_flow, server.url,
+                                            cfg_path + '/' + map_fn, img_path + '/' + data.name + '.png'))
+            results.append(self._result(links, '-s', 0, stub, self._scan_flow, server.url, data.name, cfg_path))
+            if self.cli:
+                results.append(self._result(links, 'cli -m', 0, stub, self._cli, [
+                    '-m', map_fn, '-u', '-c', cfg_path, '-i', img_path, '-w', str(self.workers)]))
+                results.append(self._result(links, 'cli -s', 0, stub, self._cli, [
+                    '-s', data.name, '-f', '-c', cfg_path, '-w', str(self.workers)]))
+        finally:
+            server.stop()
+            shutil.rmtree(tmp_dir)
+        return results
+
+    @staticmethod
+    def _write_cfg(cfg, path_fn):
+        ConfigCreate.setup_yaml()
+        with open(path_fn, 'w') as cfg_file:
+            yaml3ed.dump(ConfigCreate._dict_to_orderdict(cfg), cfg_file, explicit_start=True, explicit_end=True,
+                         default_flow_style=False, allow_unicode=True, version=(1, 2))
+
+    @staticmethod
+    def _result(links, flow, run, stub, func, *args):
+        calls = sum(stub.calls.values())
+        start = time.perf_counter()
+        phases = func(*args)
+        result = OrderedDict([('links', links), ('flow', flow), ('run', run)])
+        result.update(phases.times)
+        result['total'] = time.perf_counter() - start
+        result['requests'] = sum(stub.calls.values()) - calls
+        return result
+
+    def _map_flow(self, url, cfg_path_fn, img_path_fn):
+        phase = Phases()
+        registry = ZabbixRegistry(workers=self.workers)
+        with phase('login'):
+            registry.get(url, 'admin', 'zabbix', cache_path=os.path.dirname(cfg_path_fn) + '/.zbxcache.json')
+        with phase('load'):
+            cfg = ConfigLoader(cfg_path_fn, registry=registry)
+        with phase('fetch'):
+            cfg.fetch()
+        with phase('build'):
+            map_obj = cfg.create_map(self.font_path_fn, self.icon_path)
+        with phase('draw'):
+            map_obj.do()
+        with phase('encode'):
+            image = map_obj.encode()
+        with phase('save'):
+            map_obj.save_img(img_path_fn, image)
+        with phase('upload'):
+            cfg.upload(image)
+        registry.logout()
+        return phase
+
+    def _scan_flow(self, url, map_name, cfg_path):
+        phase = Phases()
+        registry = ZabbixRegistry(workers=self.workers)
+        with phase('login'):
+            zbx = registry.get(url, 'admin', 'zabbix', cache_path=cfg_path + '/.zbxcache.json')
+        with phase('scan'):
+            map_data = zbx.scan_map(map_name)
+        with phase('create'):
+            scan_map = ConfigCreate(map_data, zbx, registry=registry)
+            scan_map.create()
+        with phase('merge'):
+            scan_map.check_map(cfg_path)
+        with phase('save'):
+            scan_map.save(cfg_path)
+        registry.logout()
+        return phase
+
+    @staticmethod
+    def _cli(argv):
+        phase = Phases()
+        with phase('cli'):
+            WeathermapCLI(argv)
+        return phase
+
+
+def report(results, columns):
+    header = ['links', 'flow', 'run'] + list(columns) + ['total', 'requests']
+    rows = [[str(result.get(col, '')) if col in ('links', 'flow', 'run', 'requests')
+             else ('{:.3f}'.format(result[col]) if col in result else '-') for col in header] for result in results]
+    widths = [max(len(col), *(len(row[i]) for row in rows)) for i, col in enumerate(header)]
+    print('  '.join(col.rjust(widths[i]) for i, col in enumerate(header)))
+    for row in rows:
+        print('  '.join(value.rjust(widths[i]) for i, value in enumerate(row)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Weathermap benchmark with offline Zabbix stand-in')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10, 100, 1000, 10000], help='Number of map links')
+    parser.add_argument('--latency', type=float, default=0.0, help='Delay of every Zabbix request, seconds')
+    parser.add_argument('-w', '--workers', type=positive_int, default=4,
+                        help='Max number of Zabbix API requests in parallel')
+    parser.add_argument('--repeat', type=int, default=2, help='Number of -m runs, first run is with cold ID cache')
+    parser.add_argument('--no-cli', action='store_true', help='Do not run weathermap.py command line flows')
+    parser.add_argument('--json', action='store_true', help='Print results as json lines')
+    parser.add_argument('-d', '--debug', action='store_true', help='Enable debug mode')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+
+    bench = Benchmark(latency=args.latency, workers=args.workers, repeat=args.repeat, cli=not args.no_cli)
+    results = []
+    for links in args.sizes:
+        results.extend(bench.run(links))
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+    else:
+        columns = list(Benchmark.map_phases) + [phase for phase in Benchmark.scan_phases
+                                                if phase not in Benchmark.map_phases] + ['cli']
+        report(results, columns)
+
+if __name__ == '__main__':
+    main()
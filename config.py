@@ -6,10 +6,15 @@ import ruamel.yaml as yaml3ed
 from collections import OrderedDict
 import os
 import logging
-from zabbix import ZabbixAgent
-from mapping import Node, Link, Map, Table, Palette, Singleton
+from fileio import write_atomic
+from zabbix import ApiCalls, ZabbixAgent, ZabbixCache, ZabbixRegistry, ZbxException, accounting
+from mapping import ImageFormat, LabelPlacer, Node, Link, LinkState, Map, Phases, Table, Palette, Singleton
 from PIL import Image
 import base64
+import functools
+import hashlib
+import json
+import math
 import random
 from io import BytesIO
 
@@ -42,27 +47,169 @@ class ConfigTemplate(metaclass=Singleton):  # noqa
 
 
 class ConfigLoader(object):
-    def __init__(self, path_cfg: str):
-
+    # version of compiled config format
+    compiled_version = 3
+
+    def __init__(self, path_cfg: str, registry: ZabbixRegistry = None, compiled=True, phases: Phases = None,
+                 login=True):
+        """ :param compiled: use compiled config cache .name.yaml.compiled.json, it is rebuilt when config is changed
+        :param phases: Phases of load, login, fetch, geometry, state, draw, encode, save and upload,
+        not measured if None
+        :param login: login to Zabbix, False - only load and check config """
+        self.phases = phases or Phases(enabled=False)
+        # Zabbix API calls made for this map
+        self.api_calls = ApiCalls()
+        self.login = login
         self.template = ConfigTemplate().template
+        self.path_cfg = path_cfg
+        self.compiled = compiled
+        self.compiled_key = None
+        self.compiled_points = None
+        self.cfg_stat = None
         self.cfg_dict = {}
         self.obj_nodes = {}
         self.obj_links = {}
+        self.link_state = None
+        self.obj_map = None
         self.zbx = None
+        self.items_data = None
+        self.registry = registry or ZabbixRegistry()
         self.load(path_cfg)
         log.debug('Object ConfigLoader created')
 
+    def __getstate__(self):
+        """ Zabbix session stays in parent process, worker process get config and fetched data """
+        state = self.__dict__.copy()
+        state['zbx'] = None
+        state['registry'] = None
+        return state
+
     def load(self, path_cfg: str):
-        with open(path_cfg, 'r') as stream:
-            try:
-                self.cfg_dict = yaml3ed.safe_load(stream)
-            except yaml3ed.YAMLError as exc:
-                print(exc)
-        self.check()
-        self.zbx = ZabbixAgent(self.cfg_dict['zabbix']['url'], self.cfg_dict['zabbix']['login'],
-                               self.cfg_dict['zabbix']['password'])
+        with self.phases('load'):
+            with open(path_cfg, 'rb') as stream:
+                stat = os.fstat(stream.fileno())
+                raw = stream.read()
+            self.cfg_stat = (stat.st_size, stat.st_mtime_ns)
+            compiled = self._read_compiled(path_cfg, stat, raw) if self.compiled else None
+            if compiled:
+                self.cfg_dict = compiled['cfg_dict']
+                self.compiled_points = compiled['points']
+                log.debug('Compiled config loaded')
+            else:
+                self.compiled_points = None
+                try:
+                    self.cfg_dict = yaml3ed.safe_load(raw.decode('utf-8'))
+                except yaml3ed.YAMLError as exc:
+                    self.compiled_key = None
+                    print(exc)
+                self.check()
+        if not self.login:
+            log.debug('Config loaded')
+            return
+        with self.phases('login'), accounting(self.api_calls):
+            self.zbx = self.registry.get(self.cfg_dict['zabbix']['url'], self.cfg_dict['zabbix']['login'],
+                                         self.cfg_dict['zabbix']['password'], cache_path=self.cache_path())
         log.debug('Config loaded')
 
+    def cache_path(self):
+        return os.path.dirname(os.path.abspath(self.path_cfg)) + '/.zbxcache.json'
+
+    @staticmethod
+    def compiled_path(path_cfg: str):
+        return os.path.dirname(os.path.abspath(path_cfg)) + '/.' + os.path.basename(path_cfg) + '.compiled.json'
+
+    def _read_compiled(self, path_cfg: str, stat: os.stat_result, raw: bytes):
+        """ Compiled config if it is compiled from the same file: path, size, mtime and content hash.
+        Compiled config is JSON, config dir stays data-only. Any unreadable compiled config is ignored
+        :return: dict with checked cfg_dict and points of links or None """
+        self.compiled_key = [self.compiled_version, os.path.abspath(path_cfg), stat.st_size, stat.st_mtime_ns,
+                             hashlib.sha1(raw).hexdigest()]
+        try:
+            with open(self.compiled_path(path_cfg), 'r') as compiled_file:
+                compiled = json.load(compiled_file)
+            if compiled['key'] != self.compiled_key:
+                return None
+            compiled['points'] = {link: ([tuple(point) for point in input_points],
+                                         [tuple(point) for point in output_points],
+                                         list(input_label_point), list(output_label_point))
+                                  for link, (input_points, output_points, input_label_point, output_label_point)
+                                  in compiled['points'].items()}
+            if not isinstance(compiled['cfg_dict'], dict):
+                return None
+        except Exception:
+            return None
+        return compiled
+
+    def _write_compiled(self):
+        """ Save checked config and points of links """
+        if not self.compiled or not self.compiled_key:
+            return
+        points = {link: (obj.input_points, obj.output_points, obj.input_label_point, obj.output_label_point)
+                  for link, obj in self.obj_links.items()}
+        compiled_path = self.compiled_path(self.path_cfg)
+        try:
+            write_atomic(compiled_path, json.dumps({'key': self.compiled_key, 'cfg_dict': self.cfg_dict,
+                                                    'points': points}))
+        except (OSError, TypeError, ValueError) as exc:
+            log.warning('Compiled config not saved %s: %s', compiled_path, exc)
+            return
+        self.compiled_points = points
+        log.debug('Compiled config saved %s', compiled_path)
+
+    def changed(self):
+        """ :return: True if config file is modified after load """
+        try:
+            stat = os.stat(self.path_cfg)
+        except OSError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) != self.cfg_stat
+
+    def reload(self):
+        """ Load modified config, only changed nodes and links and links of changed nodes are rebuilt.
+        On error previous config stays in use
+        :return: True if config is reloaded """
+        if not self.changed():
+            return False
+        old_dict, old_compiled = self.cfg_dict, (self.compiled_key, self.compiled_points, self.zbx)
+        try:
+            self.load(self.path_cfg)
+        except Exception:
+            self.cfg_dict = old_dict
+            self.compiled_key, self.compiled_points, self.zbx = old_compiled
+            raise
+        self.items_data = None
+        self._rebuild(old_dict)
+        return True
+
+    @staticmethod
+    def _common_sections(cfg: dict) -> dict:
+        common = {section: value for section, value in cfg.items() if 'node-' not in section and 'link-' not in section}
+        common['map'] = {key: value for key, value in common['map'].items() if key != 'interval'}
+        return common
+
+    def _rebuild(self, old_dict: dict):
+        """ Drop node and link objects whose sections are changed, create_map creates them again """
+        if self._common_sections(old_dict) != self._common_sections(self.cfg_dict):
+            log.info('Config %s reloaded, map rebuilt', self.path_cfg)
+            self.obj_nodes, self.obj_links, self.link_state, self.obj_map = {}, {}, None, None
+            return
+
+        nodes = [node for node in self.obj_nodes if self.cfg_dict.get(node) != old_dict.get(node)]
+        for node in nodes:
+            del self.obj_nodes[node]
+        links = [link for link in self.obj_links
+                 if link not in self.cfg_dict or self.cfg_dict[link]['node1'] not in self.obj_nodes or
+                 self.cfg_dict[link]['node2'] not in self.obj_nodes or
+                 any(self.cfg_dict[link].get(key) != old_dict[link].get(key)
+                     for key in ('node1', 'node2', 'bandwidth', 'width'))]
+        for link in links:
+            del self.obj_links[link]
+
+        if nodes or links or [section for section in self.cfg_dict if 'node-' in section or 'link-' in section] != \
+                [section for section in old_dict if 'node-' in section or 'link-' in section]:
+            self.link_state, self.obj_map = None, None
+        log.info('Config %s reloaded, nodes rebuilt: %s, links rebuilt: %s', self.path_cfg, len(nodes), len(links))
+
     def check(self):
         for cfg_sect in self.template:
             if cfg_sect == 'node-':
@@ -103,6 +250,19 @@ class ConfigLoader(object):
                     raise ConfigException('Error in section {0}, number elements not equal 9'.format(cfg_sect))
                 continue
 
+            if cfg_sect == 'map' and self.cfg_dict.get('image'):
+                try:
+                    self.image_format()
+                except (TypeError, ValueError) as exc:
+                    raise ConfigException('Error in section image, {0}'.format(exc))
+
+            if cfg_sect == 'link' and self.cfg_dict[cfg_sect].get('thresholds'):
+                thresholds = self.cfg_dict[cfg_sect]['thresholds']
+                if len(thresholds) != 9:
+                    raise ConfigException('Error in section {0}, number of thresholds not equal 9'.format(cfg_sect))
+                if list(thresholds) != sorted(thresholds):
+                    raise ConfigException('Error in section {0}, thresholds are not ascending'.format(cfg_sect))
+
             for cfg_opt in self.template[cfg_sect]:
                 try:
                     self.cfg_dict[cfg_sect][cfg_opt]
@@ -114,13 +274,116 @@ class ConfigLoader(object):
                     raise ConfigException('The option: {0} is missing in section: [{1}]'.format(cfg_sect, cfg_opt))
         log.debug('Config check: Ok')
 
+    def items(self):
+        """ :return: set of (hostname, item key) of all links """
+        items = set()
+        for link in [section for section in self.cfg_dict if 'link-' in section]:
+            hostname = self.cfg_dict[link]['hostname']
+            for item in (self.cfg_dict[link]['itemin'], self.cfg_dict[link]['itemout']):
+                if hostname and item:
+                    items.add((hostname, item))
+        return items
+
+    def fetch(self):
+        """ Request last values of all link items by one bulk request """
+        items = self.items()
+        with self.phases('fetch'), accounting(self.api_calls):
+            self.items_data = self.zbx.get_items_data(items)
+
+    def failed_links(self):
+        """ :return: number of links with configured items not fetched or with traffic out of thresholds: error
+        or over limit, such links have no color. Links without items are drawn with zero traffic and not counted """
+        thresholds = tuple(self.cfg_dict['link'].get('thresholds') or LinkState.thresholds)
+        failed = 0
+        for link in [section for section in self.cfg_dict if 'link-' in section]:
+            section = self.cfg_dict[link]
+            hostname = section['hostname']
+            items = [item for item in (section['itemin'], section['itemout']) if hostname and item]
+            if not items:
+                continue
+            if self.items_data is None:
+                failed += 1
+                continue
+            bandwidth = section.get('bandwidth') or self.cfg_dict['link']['bandwidth']
+            for item in items:
+                value = self.items_data.get((hostname, item))
+                if value is None or LinkState.index(math.ceil(value / 1000 / (bandwidth * 10)), thresholds) < 0:
+                    failed += 1
+                    break
+        return failed
+
+    def cost(self, upload=False, image_size=0):
+        """ Predict Zabbix API calls of one run: login, fetch of items and upload of changed image,
+        item IDs and image IDs cached in .zbxcache.json are taken into account, no requests are made
+        :param image_size: size of encoded image in bytes
+        :return: ApiCalls """
+        zabbix = self.cfg_dict['zabbix']
+        cache = ZabbixCache(self.cache_path(), zabbix['url'], ttl=self.registry.cache_ttl)
+        api_calls = ZabbixAgent.estimate_login(zabbix['login'], zabbix['password'])
+        ZabbixAgent.estimate_items(self.items(), cache, api_calls)
+        if upload:
+            ZabbixAgent.estimate_upload(self.cfg_dict['map']['name'], (image_size + 2) // 3 * 4, cache, api_calls)
+        return api_calls
+
     def create_map(self, font_path_fn: str, icon_path: str):
-        self.obj_nodes = {section: None for section in self.cfg_dict if 'node-' in section}
-        self.obj_links = {section: None for section in self.cfg_dict if 'link-' in section}
+        """ Create map with last values of items, nodes, links and map are created once and reused,
+        map redraws only changed links """
         palette = self.cfg_dict['palette']
+        if self.obj_map is None:
+            with self.phases('geometry'):
+                self._create_nodes(font_path_fn, icon_path)
+                self._create_links(font_path_fn)
+
+        if self.items_data is None:
+            self.fetch()
+
+        with self.phases('state'):
+            values = []
+            for link in self.obj_links.keys():
+                hostname = self.cfg_dict[link]['hostname']
+                item_in = self.cfg_dict[link]['itemin']
+                item_out = self.cfg_dict[link]['itemout']
+
+                data_in = self.items_data[(hostname, item_in)] if hostname and item_in else 0
+                data_out = self.items_data[(hostname, item_out)] if hostname and item_out else 0
+                values.append((data_in, data_out))
+            self.link_state.update(values)
+            self.link_state.apply()
+        if self.obj_map is not None:
+            return self.obj_map
+
+        if int(self.cfg_dict['table']['show']):
+            table = Table(font_path_fn, x=int(self.cfg_dict['table']['x']), y=int(self.cfg_dict['table']['y']),
+                          palette=palette, text=LinkState.legend_text(self.cfg_dict['link'].get('thresholds')))
+        else:
+            table = None
+
+        map_width = int(self.cfg_dict['map']['width'])
+        map_height = int(self.cfg_dict['map']['height'])
+        if self.cfg_dict['map']['bgcolor']:
+            map_bgcolor = self.cfg_dict['map']['bgcolor']
+        else:
+            map_bgcolor = None
+        self.obj_map = Map(self.obj_links.values(), self.obj_nodes.values(), table=table, len_x=map_width,
+                           len_y=map_height, bgcolor=map_bgcolor, image_format=self.image_format(), phases=self.phases)
+        return self.obj_map
+
+    def image_format(self) -> ImageFormat:
+        """ Output image settings from optional section [image] """
+        image = dict(self.cfg_dict.get('image') or {})
+        if 'format' in image:
+            image['fmt'] = image.pop('format')
+        return ImageFormat(**image)
+
+    def _create_nodes(self, font_path_fn: str, icon_path: str):
+        """ Create nodes, existing node objects are kept """
+        obj_nodes, self.obj_nodes = self.obj_nodes, {section: None for section in self.cfg_dict if 'node-' in section}
         fontsize = int(self.cfg_dict['map']['fontsize'])
 
         for node in self.obj_nodes.keys():
+            if obj_nodes.get(node):
+                self.obj_nodes[node] = obj_nodes[node]
+                continue
             x = int(self.cfg_dict[node]['x'])
             y = int(self.cfg_dict[node]['y'])
 
@@ -136,7 +399,19 @@ class ConfigLoader(object):
 
             self.obj_nodes[node] = (Node(font_path_fn, icon_path, x=x, y=y, label=label, icon=icon, fontsize=fontsize))
 
+    def _create_links(self, font_path_fn: str):
+        """ Create links, existing link objects are kept, points are taken from compiled config
+        or calculated for new links """
+        obj_links, self.obj_links = self.obj_links, {section: None for section in self.cfg_dict if 'link-' in section}
+        palette = self.cfg_dict['palette']
+        fontsize = int(self.cfg_dict['map']['fontsize'])
+        compiled_points = self.compiled_points or {}
+        new_links = []
+
         for link in self.obj_links.keys():
+            if obj_links.get(link):
+                self.obj_links[link] = obj_links[link]
+                continue
             node1 = self.obj_nodes[self.cfg_dict[link]['node1']]
             node2 = self.obj_nodes[self.cfg_dict[link]['node2']]
 
@@ -151,53 +426,48 @@ class ConfigLoader(object):
                 width = self.cfg_dict['link']['width']
 
             self.obj_links[link] = (Link(font_path_fn, node1, node2, bandwidth=bandwidth, width=width,
-                                         palette=palette, fontsize=fontsize))
-
-            hostname = self.cfg_dict[link]['hostname']
-            item_in = self.cfg_dict[link]['itemin']
-            item_out = self.cfg_dict[link]['itemout']
-
-            if hostname and item_in and item_out:
-                data_in, data_out = self.zbx.get_item_data2(hostname, item_in, item_out)
-                self.obj_links[link].data(in_bps=data_in, out_bps=data_out)
-            elif hostname and item_in:
-                data_in = self.zbx.get_item_data(hostname, item_in)
-                self.obj_links[link].data(in_bps=data_in, out_bps=0)
-            elif hostname and item_out:
-                data_out = self.zbx.get_item_data(hostname, item_out)
-                self.obj_links[link].data(in_bps=0, out_bps=data_out)
+                                         palette=palette, fontsize=fontsize, points=False))
+            if link in compiled_points:
+                obj = self.obj_links[link]
+                obj.input_points, obj.output_points, obj.input_label_point, obj.output_label_point = \
+                    compiled_points[link]
             else:
-                self.obj_links[link].data(in_bps=0, out_bps=0)
-
-        if int(self.cfg_dict['table']['show']):
-            table = Table(font_path_fn, x=int(self.cfg_dict['table']['x']), y=int(self.cfg_dict['table']['y']),
-                          palette=palette)
-        else:
-            table = None
-
-        map_width = int(self.cfg_dict['map']['width'])
-        map_height = int(self.cfg_dict['map']['height'])
-        if self.cfg_dict['map']['bgcolor']:
-            map_bgcolor = self.cfg_dict['map']['bgcolor']
-        else:
-            map_bgcolor = None
-        map_obj = Map(self.obj_links.values(), self.obj_nodes.values(), table=table, len_x=map_width,
-                      len_y=map_height, bgcolor=map_bgcolor)
-        return map_obj
-
-    def upload(self, img_path_fn: str):
-        self.zbx.image_to_zabbix(img_path_fn, self.cfg_dict['map']['name'])
+                new_links.append(self.obj_links[link])
+        if new_links:
+            Link.calc_points(new_links)
+        if new_links or self.compiled_points is None:
+            self._write_compiled()
+        if self.cfg_dict['map'].get('place_labels'):
+            LabelPlacer(self.obj_nodes.values()).place_links(self.obj_links.values())
+        self.link_state = LinkState(self.obj_links.values(), thresholds=self.cfg_dict['link'].get('thresholds'))
+
+    def upload(self, image: bytes):
+        """ Upload encoded map image to Zabbix
+        :return: imageid """
+        with self.phases('upload'), accounting(self.api_calls):
+            return self.zbx.upload_image(self.cfg_dict['map']['name'], base64.b64encode(image).decode())
 
 
 class ConfigCreate(object):
-    def __init__(self, map_data: dict, zbx_agent: ZabbixAgent):
+    # ZabbixAgent methods resolving names and id getters of map elements, by elementtype
+    dict_call = ('get_hostnames', 'get_mapnames', 'get_triggernames', 'get_hostgroupnames', 'get_imagenames')
+    dict_elemid = (lambda node: node['elements'][0]['hostid'],
+                   lambda node: node['elements'][0]['sysmapid'],
+                   lambda node: node['elements'][0]['triggerid'],
+                   lambda node: node['elements'][0]['groupid'],
+                   lambda node: node['iconid_off'])
+
+    def __init__(self, map_data: dict, zbx_agent: ZabbixAgent, registry: ZabbixRegistry = None, names=None,
+                 icon_sizes=None):
+        """ :param names: resolved element names of map, see element_names, requested by create if None
+        :param icon_sizes: sizes of map icons, see icon_sizes, requested by create if None """
         self.zbx = zbx_agent
+        self.registry = registry
         self.map_data = map_data
         self.template = ConfigTemplate().template
         self.map_config = {}
-        self.dict_call = [self.zbx.get_hostname, self.zbx.get_mapname,
-                          self.zbx.get_triggername, self.zbx.get_hostgroupname,
-                          self.zbx.get_imagename]
+        self.names = names
+        self.sizes = icon_sizes
         self.cfg_loader_obj = None
         self.setup_yaml()
         log.debug('Object ConfigCreate created')
@@ -234,30 +504,23 @@ class ConfigCreate(object):
                                     'y': int(self.map_data['height']) - 300
                                     }
 
-        self.map_config['palette'] = self.template['palette']
-        self.map_config['link'] = self.template['link']
+        self.map_config['palette'] = list(self.template['palette'])
+        self.map_config['link'] = dict(self.template['link'])
+
+        names = self.names
+        if names is None:
+            names = self.element_names(self.zbx, self.map_data['selements'])
+        icon_sizes = self.sizes
+        if icon_sizes is None:
+            icon_sizes = self.icon_sizes(self.zbx, {node['iconid_off'] for node in self.map_data['selements']})
 
         for node in self.map_data['selements']:
             nodeid = node['selementid']
-
-            if int(node['elementtype']) == 4:
-                nodename = self.dict_call[int(node['elementtype'])](node['iconid_off'])
-            elif int(node['elementtype']) == 3:
-                nodename = self.dict_call[int(node['elementtype'])](node['elements'][0]['groupid'])
-            elif int(node['elementtype']) == 2:
-                nodename = self.dict_call[int(node['elementtype'])](node['elements'][0]['triggerid'])
-            elif int(node['elementtype']) == 1:
-                nodename = self.dict_call[int(node['elementtype'])](node['elements'][0]['sysmapid'])
-            elif int(node['elementtype']) == 0:
-                nodename = self.dict_call[int(node['elementtype'])](node['elements'][0]['hostid'])
-
+            elementtype = int(node['elementtype'])
+            nodename = names[elementtype][self.dict_elemid[elementtype](node)]
             elemid_dict[node['selementid']] = nodename
 
-            self.map_config['node-' + nodeid] = {'name': nodename, 'label': str(), 'icon': str()}
-
-            image_b64code = self.zbx.image_get(node['iconid_off'])
-            im = Image.open(BytesIO(base64.b64decode(image_b64code)))
-            width, height = im.size
+            width, height = icon_sizes[node['iconid_off']]
             self.map_config['node-' + nodeid] = {
                 'name': nodename,
                 'x': int(node['x']) + int(width // 2),
@@ -275,14 +538,68 @@ class ConfigCreate(object):
                                                          }
         del elemid_dict
 
+    @classmethod
+    def element_names(cls, zbx_agent: ZabbixAgent, selements: list) -> dict:
+        """ Resolve names of map elements, one bulk request for every element type
+        :return: dict {elementtype: {elementid: name}}"""
+        elementids = {}
+        for node in selements:
+            elementtype = int(node['elementtype'])
+            elementids.setdefault(elementtype, set()).add(cls.dict_elemid[elementtype](node))
+        elementtypes = sorted(elementids)
+        replies = zbx_agent.parallel([functools.partial(getattr(zbx_agent, cls.dict_call[elementtype]),
+                                                        elementids[elementtype])
+                                      for elementtype in elementtypes])
+        return dict(zip(elementtypes, replies))
+
+    @classmethod
+    def create_all(cls, maps_data: list, zbx_agent: ZabbixAgent, registry: ZabbixRegistry = None) -> list:
+        """ Config creators of many maps, names of elements and icon sizes of all maps are requested together
+        :return: list of ConfigCreate """
+        if not maps_data:
+            return []
+        selements = [node for map_data in maps_data for node in map_data['selements']]
+        names = cls.element_names(zbx_agent, selements)
+        icon_sizes = cls.icon_sizes(zbx_agent, {node['iconid_off'] for node in selements})
+        return [cls(map_data, zbx_agent, registry=registry, names=names, icon_sizes=icon_sizes)
+                for map_data in maps_data]
+
+    @staticmethod
+    def icon_sizes(zbx_agent: ZabbixAgent, iconids: set) -> dict:
+        """ Size of icons, every icon downloaded once, sizes cached
+        :return: dict {iconid: (width, height)}"""
+        sizes = {}
+        cache = zbx_agent.cache
+        if cache:
+            for iconid in iconids:
+                size = cache.get('icons', iconid)
+                if size:
+                    sizes[iconid] = tuple(size)
+        missing = iconids - set(sizes.keys())
+        if missing:
+            for iconid, image_b64code in zbx_agent.get_images(missing).items():
+                im = Image.open(BytesIO(base64.b64decode(image_b64code)))
+                sizes[iconid] = im.size
+                if cache:
+                    cache.set('icons', iconid, list(im.size))
+            if cache:
+                cache.save()
+        for iconid in iconids:
+            if iconid not in sizes:
+                raise ZbxException('image not found, id: {}'.format(iconid))
+        return sizes
+
     @staticmethod
     def _dict_to_orderdict(cfg: dict) -> OrderedDict:
         cfg_order = OrderedDict()
-        cfg_templ = OrderedDict([('map', ('name', 'bgcolor', 'fontsize', 'width', 'height')),
+        cfg_templ = OrderedDict([('map', ('name', 'bgcolor', 'fontsize', 'width', 'height', 'interval',
+                                          'place_labels')),
                                  ('zabbix', ('url', 'login', 'password')),
                                  ('table', ('show', 'x', 'y')),
                                  ('palette', None),
-                                 ('link', ('bandwidth', 'width')),
+                                 ('link', ('bandwidth', 'width', 'thresholds')),
+                                 ('image', ('format', 'mode', 'palette', 'colors', 'compress_level', 'optimize',
+                                            'lossless', 'quality')),
                                  ('node-', ('name', 'label', 'icon', 'x', 'y')),
                                  ('link-', ('node1', 'node2', 'name1', 'name2', 'copy', 'width', 'bandwidth',
                                             'hostname', 'itemin', 'itemout'))
@@ -314,13 +631,22 @@ class ConfigCreate(object):
                         cfg_order[link][cfg_opt] = cfg[link][cfg_opt]
                 continue
 
+            if cfg_sect == 'image':
+                if cfg.get(cfg_sect):
+                    cfg_order[cfg_sect] = OrderedDict((cfg_opt, cfg[cfg_sect][cfg_opt])
+                                                      for cfg_opt in cfg_templ[cfg_sect] if cfg_opt in cfg[cfg_sect])
+                continue
+
             cfg_order[cfg_sect] = OrderedDict()
             if cfg_sect == 'palette':
                 cfg_order[cfg_sect] = cfg[cfg_sect]
                 continue
 
             for cfg_opt in cfg_templ[cfg_sect]:
-                if cfg_sect == 'map' and cfg_opt == 'bgcolor' and cfg_opt not in cfg[cfg_sect]:
+                if cfg_sect == 'map' and cfg_opt in ('bgcolor', 'interval', 'place_labels') and \
+                        cfg_opt not in cfg[cfg_sect]:
+                    continue
+                if cfg_sect == 'link' and cfg_opt == 'thresholds' and cfg_opt not in cfg[cfg_sect]:
                     continue
                 cfg_order[cfg_sect][cfg_opt] = cfg[cfg_sect][cfg_opt]
         return cfg_order
@@ -342,7 +668,7 @@ class ConfigCreate(object):
 
     def _compare(self, old_cfg_path_file: str):
 
-        self.cfg_loader_obj = ConfigLoader(old_cfg_path_file)
+        self.cfg_loader_obj = ConfigLoader(old_cfg_path_file, registry=self.registry, login=False)
         config_old = self.cfg_loader_obj.cfg_dict
 
         for section in [sect for sect in self.template.keys()
@@ -355,6 +681,14 @@ class ConfigCreate(object):
             for option in self.template[section]:
                 self.map_config[section][option] = config_old[section][option]
 
+        for option in ('interval', 'place_labels'):
+            if config_old['map'].get(option):
+                self.map_config['map'][option] = config_old['map'][option]
+        if config_old['link'].get('thresholds'):
+            self.map_config['link']['thresholds'] = config_old['link']['thresholds']
+        if config_old.get('image'):
+            self.map_config['image'] = config_old['image']
+
         for section in self.map_config:
             if 'node-' in section:
                 if config_old.get(section):
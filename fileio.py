@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# __author__ = 'maximus'
+
+""" Atomic file writes: images, fingerprints, metrics and caches are written to temporary file and renamed,
+readers never see half-written file """
+
+import logging
+import os
+import tempfile
+
+log = logging.getLogger(__name__)
+
+
+def umask():
+    """ Process umask without changing it, from /proc on Linux, 022 elsewhere """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0o022
+
+
+def file_mode(path):
+    """ :return: permissions for file replacing path: mode of existing file or default mode of new file """
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except OSError:
+        return 0o666 & ~umask()
+
+
+def write_atomic(path, data):
+    """ Write data to temporary file in directory of path and rename it to path, mode of replaced file is kept.
+    Temporary file is removed if write fails
+    :param data: bytes or str """
+    path = os.path.abspath(path)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as tmp_file:
+            tmp_file.write(data)
+        os.chmod(tmp_path, file_mode(path))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    log.debug('File written %s', path)
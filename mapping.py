@@ -2,11 +2,24 @@
 # -*- coding: utf-8 -*-
 # __author__ = 'maximus'
 
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+from collections import OrderedDict
 from datetime import datetime
+from io import BytesIO
+import bisect
+import hashlib
 import math
 import os
 import logging
+import threading
+import time
+
+from fileio import write_atomic
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 log = logging.getLogger(__name__)
 
@@ -20,6 +33,46 @@ class Singleton(type):
         return cls._instances[cls]
 
 
+class Phases(object):
+    """ Collect duration of named phases, durations of phases with the same name are summed.
+    Disabled instance measures nothing """
+
+    class Phase(object):
+        __slots__ = ('times', 'name', 'start')
+
+        def __init__(self, times, name):
+            self.times = times
+            self.name = name
+            self.start = None
+
+        def __enter__(self):
+            self.start = time.perf_counter()
+
+        def __exit__(self, *args):
+            self.times[self.name] = self.times.get(self.name, 0.0) + time.perf_counter() - self.start
+
+    class NoPhase(object):
+        def __enter__(self):
+            pass
+
+        def __exit__(self, *args):
+            pass
+
+    no_phase = NoPhase()
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.times = OrderedDict()
+
+    def __call__(self, name):
+        if not self.enabled:
+            return self.no_phase
+        return self.Phase(self.times, name)
+
+    def reset(self):
+        self.times = OrderedDict()
+
+
 class Palette(metaclass=Singleton):  # noqa
     def __init__(self):
         self.palette = ['#908C8C', '#FFFFFF', '#8000FF', '#0000FF', '#00EAEA', '#00FF00', '#FFFF00', '#FF9933',
@@ -32,8 +85,74 @@ class Palette(metaclass=Singleton):  # noqa
         self.palette = list(self.palette_default)
 
 
+class IconCache(metaclass=Singleton):  # noqa
+    """ Decoded RGBA icons shared by all nodes and maps of process, LRU keyed by real path and mtime """
+    def __init__(self, size=64):
+        self.size = size
+        self.icons = OrderedDict()
+        self.lock = threading.Lock()
+        log.debug('Object singleton IconCache created')
+
+    def get(self, path):
+        """ Icon image in RGBA mode, decoded once while file is not changed. Do not modify returned image
+        :param path: icon file path
+        :return: PIL Image """
+        path = os.path.realpath(path)
+        key = (path, os.path.getmtime(path))
+        with self.lock:
+            if key in self.icons:
+                self.icons.move_to_end(key)
+                return self.icons[key]
+        with Image.open(path) as im:
+            icon = im.convert('RGBA')
+        with self.lock:
+            self.icons[key] = icon
+            while len(self.icons) > self.size:
+                self.icons.popitem(last=False)
+        log.debug('Icon decoded %s', path)
+        return icon
+
+    def clear(self):
+        with self.lock:
+            self.icons.clear()
+
+
+class FontCache(metaclass=Singleton):  # noqa
+    """ Fonts loaded once per (fontfile, size) and text bounding boxes, shared by Label, Table and Node """
+    def __init__(self, bbox_size=4096):
+        self.fonts = {}
+        self.bboxes = OrderedDict()
+        self.bbox_size = bbox_size
+        self.lock = threading.Lock()
+        log.debug('Object singleton FontCache created')
+
+    def get(self, fontfile, size):
+        """ :return: ImageFont.FreeTypeFont """
+        key = (fontfile, size)
+        with self.lock:
+            if key not in self.fonts:
+                self.fonts[key] = ImageFont.truetype(fontfile, size=size)
+                log.debug('Font loaded %s %s', fontfile, size)
+            return self.fonts[key]
+
+    def bbox(self, fontfile, size, text):
+        """ Bounding box of text drawn at (0, 0)
+        :return: tuple (left, top, right, bottom) """
+        key = (fontfile, size, text)
+        with self.lock:
+            if key in self.bboxes:
+                self.bboxes.move_to_end(key)
+                return self.bboxes[key]
+        bbox = self.get(fontfile, size).getbbox(text)
+        with self.lock:
+            self.bboxes[key] = bbox
+            if len(self.bboxes) > self.bbox_size:
+                self.bboxes.popitem(last=False)
+        return bbox
+
+
 class Table(object):
-    def __init__(self, fontfile, x=0, y=0, palette=Palette().palette_default, fontsize=12, dt=True):
+    def __init__(self, fontfile, x=0, y=0, palette=Palette().palette_default, fontsize=12, dt=True, text=None):
         self.x = x
         self.y = y
         self.width_palet = 30
@@ -45,11 +164,11 @@ class Table(object):
         self.text_label = 'Traffic Load'
         self.rect_xy = []
         self.table_xy()
-        self.text = ('0-0%', '0-1%', '1-10%', '10-25%', '25-40%', '40-55%', '55-70%', '70-85%', '85-100%')
+        self.text = tuple(text) if text else LinkState.legend
         self.fontfile = fontfile
         self.fontcolor = 'black'
         self.fontsize = fontsize
-        self.font = ImageFont.truetype(self.fontfile, size=self.fontsize)
+        self.font = FontCache().get(self.fontfile, self.fontsize)
         self.dt = dt
         self.dt_obj = None
         self.date_now = None
@@ -64,16 +183,27 @@ class Table(object):
             y2 = self.yt + self.height_palet * (i + 1)
             self.rect_xy.append((x1, y1, x2, y2))
 
-    def draw_table(self, draw):
+    def draw_table(self, draw, dt=None):
+        """ Draw legend and date time
+        :param dt: draw date time, default self.dt """
         draw.rectangle((self.x, self.y, self.rect_xy[8][2] + 60, self.rect_xy[8][3] + 5), outline='black', fill='white')
         draw.text((self.x + 5, self.y + 5), self.text_label, fill='black', font=self.font)
 
         for i in range(0, 9):
             draw.rectangle(self.rect_xy[i], fill=self.palette[i], outline=self.palette[i])
             draw.text((self.rect_xy[i][2] + 2, self.rect_xy[i][1] + 2), self.text[i], fill='black', font=self.font)
-        if self.dt:
+        if self.dt if dt is None else dt:
             self.draw_datetime(draw)
 
+    def key(self):
+        """ Legend settings, key of map static layer """
+        return self.x, self.y, tuple(self.palette), self.text, self.fontfile, self.fontsize
+
+    def datetime_bbox(self):
+        """ Box of map region of date time """
+        return (self.x - self.fontsize, self.rect_xy[9][1] + 5 - self.fontsize,
+                self.rect_xy[10][2] + 61 + self.fontsize, self.rect_xy[10][3] + 6 + self.fontsize)
+
     def draw_datetime(self, draw):
         self.dt_obj = datetime.now()
         self.date_now = datetime.strftime(self.dt_obj, "%d.%m.%Y")
@@ -93,8 +223,9 @@ class Label(object):
         self.fontcolor = fontcolor
         self.fontsize = fontsize
         self.fontfile = fontfile
-        self.font = ImageFont.truetype(self.fontfile, size=self.fontsize)
+        self.font = FontCache().get(self.fontfile, self.fontsize)
         self.name = str(label)
+        self.point = point
         self.points = [0, 0, 0, 0]
         self.point_name = [0, 0]
         self.font_width = {8: 6, 10: 7.4, 12: 8, 14: 9, 16: 11, 18: 12, 20: 13}
@@ -108,6 +239,22 @@ class Label(object):
             self.label_xy(point)
         log.debug('Object Label created')
 
+    def text_bbox(self):
+        """ Bounding box of label text drawn at (0, 0) """
+        return FontCache().bbox(self.fontfile, self.font.size, self.name)
+
+    def key(self):
+        """ Everything drawn by label """
+        return (self.name, tuple(self.points), tuple(self.point_name), self.fontfile, self.fontsize, self.bgcolor,
+                self.fontcolor, self.outline)
+
+    def bbox(self):
+        """ Box of map region changed by label: rectangle and text """
+        text = self.text_bbox()
+        return (min(self.points[0], self.point_name[0] + text[0]), min(self.points[1], self.point_name[1] + text[1]),
+                max(self.points[2], self.point_name[0] + text[2]) + 1,
+                max(self.points[3], self.point_name[1] + text[3]) + 1)
+
     def label_xy(self, point):
         """font_dict = {fontsize:symbol width}
         symbol height = fontsize
@@ -139,21 +286,25 @@ class Node(object):
 
     def icon_xy(self):
         if os.path.isfile(self.icon_path + '/' + self.icon):
-            im = Image.open(self.icon_path + '/' + self.icon)
+            im = IconCache().get(self.icon_path + '/' + self.icon)
         else:
-            im = Image.open(self.icon)
+            im = IconCache().get(self.icon)
         width, height = im.size
         x = int(self.x - width/2)
         y = int(self.y - height/2)
-        im.close()
         return [x, y]
 
 
 class Link(object):
     """ A line between two Nodes. The line contains two arrows: one for an input
     value and one for an output value"""
+    # arrow points offsets (x, y) in link widths, None is arrow end point
+    arrow_offsets = ((0, 1), (-4, 1), (-4, 2), None, (-4, -2), (-4, -1), (0, -1))
+
     def __init__(self, fontfile, node_a, node_b, bandwidth=1000, width=5, palette=Palette().palette_default,
-                 fontsize=10):
+                 fontsize=10, points=True, thresholds=None):
+        """ :param points: calculate arrows and labels points, False if they are calculated by Link.calc_points
+        :param thresholds: lower bounds of load in percent for every palette color, default LinkState.thresholds """
         self.node_a = node_a
         self.node_b = node_b
         self.fontfile = fontfile
@@ -161,12 +312,20 @@ class Link(object):
         self.bandwidth = bandwidth
         self.width = float(width)
         self.palette = palette
-        self.input_points = self._get_input_arrow_points()
-        self.output_points = self._get_output_arrow_points()
+        self.thresholds = tuple(thresholds) if thresholds else LinkState.thresholds
+        self.input_points = None
+        self.output_points = None
+        self.input_label_point = None
+        self.output_label_point = None
+        # points of input and output labels moved by LabelPlacer, None - labels are on label points
+        self.label_points = None
+        if points:
+            self._calc_points()
         self.incolor = None
         self.outcolor = None
         self.in_label = None
         self.out_label = None
+        self.dirty = []
         log.debug('Object Link created')
 
     @staticmethod
@@ -184,59 +343,122 @@ class Link(object):
         """ Calculate "y" coordinate """
         return int(math.sin(math.atan2(y, x) + math.atan2(b, a))*math.sqrt(x*x+y*y))
 
+    def _calc_points(self):
+        self.input_points = self._get_input_arrow_points()
+        self.output_points = self._get_output_arrow_points()
+        self.input_label_point = self._get_input_label_point()
+        self.output_label_point = self._get_output_label_point()
+
+    @classmethod
+    def calc_points(cls, links):
+        """ Calculate arrows and labels points of all links at once, vectorized if numpy is installed.
+        Points are equal to points calculated by every link
+        :param links: iterable of Link """
+        links = list(links)
+        if numpy is None or not links:
+            for link in links:
+                link._calc_points()
+            return
+
+        ax = numpy.array([link.node_a.x for link in links], dtype=numpy.float64)
+        ay = numpy.array([link.node_a.y for link in links], dtype=numpy.float64)
+        bx = numpy.array([link.node_b.x for link in links], dtype=numpy.float64)
+        by = numpy.array([link.node_b.y for link in links], dtype=numpy.float64)
+        width = numpy.array([link.width for link in links], dtype=numpy.float64)
+
+        in_x, in_y = cls._middle_vec(ax, bx), cls._middle_vec(ay, by)
+        out_x, out_y = cls._middle_vec(bx, ax), cls._middle_vec(by, ay)
+        input_points = cls._arrow_points_vec(ax, ay, in_x, in_y, width)
+        output_points = cls._arrow_points_vec(bx, by, out_x, out_y, width)
+        input_label = numpy.stack((cls._middle_vec(ax, in_x), cls._middle_vec(ay, in_y)),
+                                  axis=1).astype(numpy.int64).tolist()
+        output_label = numpy.stack((cls._middle_vec(bx, out_x), cls._middle_vec(by, out_y)),
+                                   axis=1).astype(numpy.int64).tolist()
+
+        for i, link in enumerate(links):
+            link.input_points = list(map(tuple, input_points[i]))
+            link.output_points = list(map(tuple, output_points[i]))
+            link.input_label_point = input_label[i]
+            link.output_label_point = output_label[i]
+        log.debug('Points of %s links calculated', len(links))
+
+    @staticmethod
+    def _middle_vec(x, y):
+        """ Vectorized _middle """
+        return numpy.trunc(x + (y - x) / 2)
+
+    @classmethod
+    def _arrow_points_vec(cls, x1, y1, x2, y2, width):
+        """ Vectorized _get_arrow_points, values near integer are recalculated with math
+        to truncate them like _new_x and _new_y
+        :return: list of arrows, arrow is list of [x, y] """
+        a = x2 - x1
+        b = y2 - y1
+        angle_ab = numpy.arctan2(b, a)
+        points = []
+        for offset in cls.arrow_offsets:
+            if offset is None:
+                points.append(numpy.stack((x2, y2), axis=1))
+                continue
+            x = offset[0] * width
+            y = offset[1] * width
+            angle = numpy.arctan2(y, x) + angle_ab
+            radius = numpy.sqrt(x * x + y * y)
+            new_x = numpy.cos(angle) * radius
+            new_y = numpy.sin(angle) * radius
+            for values, fn in ((new_x, cls._new_x), (new_y, cls._new_y)):
+                for i in numpy.flatnonzero(numpy.abs(values - numpy.rint(values)) < 1e-6):
+                    values[i] = fn(a[i], b[i], x[i], y[i])
+            base_x, base_y = (x1, y1) if offset[0] == 0 else (x2, y2)
+            points.append(numpy.stack((base_x + numpy.trunc(new_x), base_y + numpy.trunc(new_y)), axis=1))
+        return numpy.stack(points, axis=1).astype(numpy.int64).tolist()
+
     def data(self, in_bps=0000, out_bps=749890567):
         in_kps = in_bps/1000
         out_kps = out_bps/1000
-        self._fill_arrow(in_kps, out_kps)
         in_name, out_name = self._name(in_kps, out_kps)
-        in_point = self._get_input_label_point()
-        out_point = self._get_output_label_point()
-        self.in_label = Label(self.fontfile, label=in_name, point=in_point, fontsize=self.fontsize)
-        self.out_label = Label(self.fontfile, label=out_name, point=out_point, fontsize=self.fontsize)
+        self.update(self._color(in_kps), self._color(out_kps), in_name, out_name)
+
+    def update(self, incolor, outcolor, in_name, out_name):
+        """ Set colors and label texts in place, boxes of changed map regions are added to self.dirty """
+        in_point, out_point = self.label_points or (self.input_label_point, self.output_label_point)
+        if incolor != self.incolor:
+            self.incolor = incolor
+            self.dirty.append(self.arrow_bbox(self.input_points))
+        if outcolor != self.outcolor:
+            self.outcolor = outcolor
+            self.dirty.append(self.arrow_bbox(self.output_points))
+        if self.in_label is None or self.in_label.name != in_name or self.in_label.point != in_point:
+            if self.in_label is not None:
+                self.dirty.append(self.in_label.bbox())
+            self.in_label = Label(self.fontfile, label=in_name, point=in_point, fontsize=self.fontsize)
+            self.dirty.append(self.in_label.bbox())
+        if self.out_label is None or self.out_label.name != out_name or self.out_label.point != out_point:
+            if self.out_label is not None:
+                self.dirty.append(self.out_label.bbox())
+            self.out_label = Label(self.fontfile, label=out_name, point=out_point, fontsize=self.fontsize)
+            self.dirty.append(self.out_label.bbox())
 
     @staticmethod
-    def _name(in_kps, out_kps):
-        if 0 <= in_kps <= 999:
-            in_label = str(round(in_kps, 2)) + 'K'
-
-        elif 999 < in_kps <= 999999:
-            in_mps = in_kps/1000
-            in_label = str(round(in_mps, 2)) + 'M'
+    def arrow_bbox(points):
+        """ Box of map region of arrow with outline """
+        return (min(point[0] for point in points), min(point[1] for point in points),
+                max(point[0] for point in points) + 1, max(point[1] for point in points) + 1)
+
+    def bbox(self):
+        """ Box of map region of both arrows and labels """
+        boxes = [self.arrow_bbox(self.input_points), self.arrow_bbox(self.output_points)]
+        boxes.extend(label.bbox() for label in (self.in_label, self.out_label) if label is not None)
+        return (min(box[0] for box in boxes), min(box[1] for box in boxes),
+                max(box[2] for box in boxes), max(box[3] for box in boxes))
 
-        elif in_kps > 999999:
-            in_gps = in_kps/1000000
-            in_label = str(round(in_gps, 2)) + 'G'
-
-        else:
-            in_label = 'ERR'
-
-        if 0 <= out_kps <= 999:
-            out_label = str(round(out_kps, 2)) + 'K'
-
-        elif 999 < out_kps <= 999999:
-            out_mps = out_kps/1000
-            out_label = str(round(out_mps, 2)) + 'M'
-
-        elif out_kps > 999999:
-            out_gps = out_kps/1000000
-            out_label = str(round(out_gps, 2)) + 'G'
-
-        else:
-            out_label = 'ERR'
-
-        return in_label, out_label
-
-    def _fill_arrow(self, in_kps, out_kps):
-        switch = ((0, 0, 1), (1, 1, 2), (2, 2, 10), (3, 10, 25), (4, 25, 40), (5, 40, 55), (6, 55, 70), (7, 70, 85),
-                  (8, 85, 100), (8, 100, 100000))
+    @staticmethod
+    def _name(in_kps, out_kps):
+        return LinkState.label(in_kps), LinkState.label(out_kps)
 
-        in_percent = math.ceil(in_kps / (self.bandwidth * 10))
-        out_percent = math.ceil(out_kps / (self.bandwidth * 10))
-        for sw in switch:
-            if in_percent in range(sw[1], sw[2]):
-                self.incolor = self.palette[sw[0]]
-            if out_percent in range(sw[1], sw[2]):
-                self.outcolor = self.palette[sw[0]]
+    def _color(self, kps):
+        index = LinkState.index(math.ceil(kps / (self.bandwidth * 10)), self.thresholds)
+        return self.palette[index] if index >= 0 else None
 
     def _get_arrow_points(self, x1, y1, x2, y2, width):
         """
@@ -305,15 +527,288 @@ class Link(object):
         return points
 
 
+class LinkState(object):
+    """ Traffic of all links of a map in columns: in bps, out bps and bandwidth.
+    Links are classified to palette colors and labels are formatted for all links at once,
+    vectorized if numpy is installed """
+    # lower bounds of load in percent (rounded up) for palette colors
+    thresholds = (0, 1, 2, 10, 25, 40, 55, 70, 85)
+    legend = ('0-0%', '0-1%', '1-10%', '10-25%', '25-40%', '40-55%', '55-70%', '70-85%', '85-100%')
+    # load in percent from this value has no color
+    limit = 100000
+
+    def __init__(self, links, thresholds=None):
+        self.links = list(links)
+        self.thresholds = tuple(thresholds) if thresholds else LinkState.thresholds
+        for link in self.links:
+            link.thresholds = self.thresholds
+        self.bandwidth = self._column([link.bandwidth for link in self.links])
+        self.in_bps = self._column([0] * len(self.links))
+        self.out_bps = self._column([0] * len(self.links))
+
+    @staticmethod
+    def _column(values):
+        if numpy is None:
+            return list(values)
+        return numpy.array(values, dtype=numpy.float64)
+
+    @classmethod
+    def legend_text(cls, thresholds=None):
+        """ Legend table text for thresholds """
+        if not thresholds or tuple(thresholds) == cls.thresholds:
+            return cls.legend
+        bounds = list(thresholds[1:]) + [100]
+        return tuple('{}-{}%'.format(low, high) for low, high in zip(thresholds, bounds))
+
+    @classmethod
+    def index(cls, percent, thresholds):
+        """ Palette index of load in percent, -1 if load is out of thresholds """
+        if not thresholds[0] <= percent < cls.limit:
+            return -1
+        return bisect.bisect_right(thresholds, percent) - 1
+
+    @staticmethod
+    def label(kps):
+        """ Label text of traffic in kbps """
+        if 0 <= kps <= 999:
+            return str(round(kps, 2)) + 'K'
+        elif 999 < kps <= 999999:
+            return str(round(kps / 1000, 2)) + 'M'
+        elif kps > 999999:
+            return str(round(kps / 1000000, 2)) + 'G'
+        return 'ERR'
+
+    def update(self, values):
+        """ Set traffic of all links
+        :param values: list of tuples (in_bps, out_bps) in order of links """
+        self.in_bps = self._column([value[0] for value in values])
+        self.out_bps = self._column([value[1] for value in values])
+
+    def classify(self, kps):
+        """ Palette indexes of links traffic, -1 if load is out of thresholds
+        :param kps: column of traffic in kbps
+        :return: list of int """
+        if numpy is None:
+            return [self.index(math.ceil(value / (bandwidth * 10)), self.thresholds)
+                    for value, bandwidth in zip(kps, self.bandwidth)]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            percent = numpy.ceil(kps / (self.bandwidth * 10))
+        indexes = numpy.searchsorted(self.thresholds, percent, side='right') - 1
+        indexes[~((percent >= self.thresholds[0]) & (percent < self.limit))] = -1
+        return indexes.tolist()
+
+    def labels(self, kps):
+        """ Label texts of links traffic
+        :param kps: column of traffic in kbps
+        :return: list of str """
+        if numpy is None:
+            return [self.label(value) for value in kps]
+        scale = numpy.select([(kps >= 0) & (kps <= 999), (kps > 999) & (kps <= 999999), kps > 999999],
+                             [1, 1000, 1000000], 0)
+        values = numpy.divide(kps, scale, out=numpy.zeros_like(kps), where=scale > 0).tolist()
+        suffix = {1: 'K', 1000: 'M', 1000000: 'G'}
+        return [str(round(value, 2)) + suffix[unit] if unit else 'ERR' for value, unit in zip(values, scale.tolist())]
+
+    def apply(self):
+        """ Set colors and labels of all links """
+        if numpy is None:
+            in_kps = [value / 1000 for value in self.in_bps]
+            out_kps = [value / 1000 for value in self.out_bps]
+        else:
+            in_kps = self.in_bps / 1000
+            out_kps = self.out_bps / 1000
+        states = zip(self.links, self.classify(in_kps), self.classify(out_kps), self.labels(in_kps),
+                     self.labels(out_kps))
+        for link, in_index, out_index, in_name, out_name in states:
+            link.update(link.palette[in_index] if in_index >= 0 else None,
+                        link.palette[out_index] if out_index >= 0 else None, in_name, out_name)
+        log.debug('State of %s links applied', len(self.links))
+
+
+class ImageFormat(object):
+    """ Output image settings
+    :param fmt: png or webp
+    :param mode: RGBA, RGB or P
+    :param palette: adaptive or fixed, colors of P mode: adaptive - quantized image colors,
+    fixed - map palette, black, white, background color and web safe colors
+    :param colors: number of colors of adaptive palette
+    :param compress_level: zlib compression level of png, 0-9
+    :param optimize: png optimize
+    :param lossless: webp lossless
+    :param quality: webp quality, 0-100 """
+    formats = ('png', 'webp')
+    modes = ('RGBA', 'RGB', 'P')
+    palettes = ('adaptive', 'fixed')
+
+    def __init__(self, fmt='png', mode='RGBA', palette='adaptive', colors=256, compress_level=6, optimize=False,
+                 lossless=True, quality=80):
+        self.fmt = str(fmt).lower()
+        self.mode = str(mode).upper()
+        self.palette = str(palette).lower()
+        self.colors = int(colors)
+        self.compress_level = int(compress_level)
+        self.optimize = bool(optimize)
+        self.lossless = bool(lossless)
+        self.quality = int(quality)
+        if self.fmt not in self.formats or self.mode not in self.modes or self.palette not in self.palettes:
+            raise ValueError('Unsupported image format: {} {} {}'.format(fmt, mode, palette))
+
+    @property
+    def extension(self):
+        return '.' + self.fmt
+
+    def key(self):
+        return (self.fmt, self.mode, self.palette, self.colors, self.compress_level, self.optimize, self.lossless,
+                self.quality)
+
+    def convert(self, image, bgcolor=None, colors=()):
+        """ Image in output mode
+        :param bgcolor: background of RGB image, default white
+        :param colors: colors of fixed palette """
+        if self.mode == 'RGBA':
+            return image
+        if self.mode == 'P' and self.palette == 'adaptive':
+            return image.quantize(colors=self.colors, method=Image.Quantize.FASTOCTREE)
+        rgb = Image.new('RGBA', image.size, bgcolor or 'white')
+        rgb.alpha_composite(image)
+        rgb = rgb.convert('RGB')
+        if self.mode == 'RGB':
+            return rgb
+        return rgb.quantize(palette=self._palette_image(list(colors) + ['black', 'white', bgcolor or 'white']),
+                            dither=Image.Dither.NONE)
+
+    @staticmethod
+    def _palette_image(colors):
+        rgb = []
+        for color in colors:
+            rgb.append(ImageColor.getrgb(color)[0:3])
+        steps = (0, 51, 102, 153, 204, 255)
+        rgb.extend((r, g, b) for r in steps for g in steps for b in steps)
+        rgb = list(OrderedDict.fromkeys(rgb))[0:256]
+        palette = Image.new('P', (1, 1))
+        palette.putpalette([value for color in rgb for value in color])
+        return palette
+
+    def save(self, image, fp, bgcolor=None, colors=()):
+        """ Save image to file path or file object """
+        image = self.convert(image, bgcolor, colors)
+        if self.fmt == 'webp':
+            image.save(fp, 'WEBP', lossless=self.lossless, quality=self.quality)
+        else:
+            image.save(fp, 'PNG', compress_level=self.compress_level, optimize=self.optimize)
+
+
+class Grid(object):
+    """ Spatial index of boxes (x1, y1, x2, y2) in square cells """
+    def __init__(self, cell=64):
+        self.cell = cell
+        self.cells = {}
+
+    def cells_of(self, box):
+        for cell_x in range(box[0] // self.cell, (box[2] - 1) // self.cell + 1):
+            for cell_y in range(box[1] // self.cell, (box[3] - 1) // self.cell + 1):
+                yield cell_x, cell_y
+
+    def cell_box(self, cell):
+        return cell[0] * self.cell, cell[1] * self.cell, (cell[0] + 1) * self.cell, (cell[1] + 1) * self.cell
+
+    def add(self, key, box):
+        for cell in self.cells_of(box):
+            self.cells.setdefault(cell, set()).add(key)
+
+    def query(self, cells):
+        """ Keys of boxes in cells """
+        keys = set()
+        for cell in cells:
+            keys.update(self.cells.get(cell, ()))
+        return keys
+
+
+class LabelPlacer(object):
+    """ Moves link labels along their arrows to the nearest place free of icons, node labels and other link labels.
+    Boxes are indexed in Grid, every label is checked only against boxes in its cells """
+    # label box is reserved for text of this length, like 999.99M
+    chars = 7
+    # max number of steps to each side of label point
+    steps = 16
+
+    def __init__(self, nodes, cell=64):
+        self.grid = Grid(cell)
+        self.boxes = []
+        for node in nodes or ():
+            if node.icon:
+                icon = node.icon_path + '/' + node.icon
+                width, height = IconCache().get(icon if os.path.isfile(icon) else node.icon).size
+                self._add((node.icon_point[0], node.icon_point[1], node.icon_point[0] + width,
+                           node.icon_point[1] + height))
+            if node.label_obj:
+                self._add(node.label_obj.bbox())
+
+    def _add(self, box):
+        self.grid.add(len(self.boxes), box)
+        self.boxes.append(box)
+
+    def free(self, box):
+        """ :return: True if box does not intersect indexed boxes """
+        for key in self.grid.query(self.grid.cells_of(box)):
+            other = self.boxes[key]
+            if box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]:
+                return False
+        return True
+
+    def place(self, start, end, point, fontfile, fontsize):
+        """ Nearest free point of label on arrow from start to end, label point if there is no free place
+        :return: point [x, y] """
+        label = Label(fontfile, label='0' * self.chars, point=point, fontsize=fontsize)
+        box = label.bbox()
+        length = math.hypot(end[0] - start[0], end[1] - start[1])
+        step = label.fontsize
+        if length:
+            offsets = [0]
+            for shift in range(1, min(self.steps, int(length / 2 / step)) + 1):
+                offsets.extend((shift * step, -shift * step))
+            for offset in offsets:
+                dx = int(round(offset * (end[0] - start[0]) / length))
+                dy = int(round(offset * (end[1] - start[1]) / length))
+                moved = (box[0] + dx, box[1] + dy, box[2] + dx, box[3] + dy)
+                if self.free(moved):
+                    self._add(moved)
+                    return [point[0] + dx, point[1] + dy]
+        self._add(box)
+        return list(point)
+
+    def place_links(self, links):
+        """ Set label_points of links """
+        for link in links:
+            a, b = (link.node_a.x, link.node_a.y), (link.node_b.x, link.node_b.y)
+            middle = (link._middle(a[0], b[0]), link._middle(a[1], b[1]))
+            link.label_points = (self.place(a, middle, link.input_label_point, link.fontfile, link.fontsize),
+                                 self.place(b, middle, link.output_label_point, link.fontfile, link.fontsize))
+
+
 class Map(object):
-    def __init__(self, links, nodes, table=None, len_x=800, len_y=800, bgcolor=None, ):
+    # dirty area share of map from which whole map is redrawn
+    redraw_limit = 0.5
+
+    def __init__(self, links, nodes, table=None, len_x=800, len_y=800, bgcolor=None, image_format=None,
+                 phases=None):
+        """ :param phases: Phases of draw, encode and save, not measured if None """
         # Link instance
+        self.phases = phases or Phases(enabled=False)
         self.bgcolor = bgcolor
-        self.links = links
+        self.image_format = image_format or ImageFormat()
+        self.links = list(links) if links else links
         self.table = table
         self.nodes = nodes
+        self.len_x = len_x
+        self.len_y = len_y
         self.image = self.create_image(len_x, len_y)
         self.draw = ImageDraw.Draw(self.image)
+        self.frame_key = None
+        # static layers of last frame: tuple (static_key, base, overlay, mask)
+        self.static = None
+        self.grid = None
+        self.extents = []
         log.debug('Object Map created')
 
     def create_image(self, x, y):
@@ -324,28 +819,26 @@ class Map(object):
         img = Image.new("RGBA", (x, y), self.bgcolor)
         return img
 
-    def _draw_polygon(self, points, color):
+    def _draw_polygon(self, points, color, draw=None):
         """
         Draw the polygon (the arrow) for giving points
         @param points: list of points
         @param color: inside color of polygon (arrow)
         """
+        draw = draw or self.draw
+        draw.polygon(points, fill=color, outline='black')
 
-        self.draw.polygon(points, fill=color, outline='black')
+    def _draw_label(self, label, draw=None):
+        draw = draw or self.draw
+        draw.rectangle(label.points, fill=label.bgcolor, outline=label.outline)
+        draw.text((label.point_name[0:2]), label.name, fill=label.fontcolor,
+                  font=label.font)
 
-    def _draw_label(self, label):
-        self.draw.rectangle(label.points, fill=label.bgcolor, outline=label.outline)
-        self.draw.text((label.point_name[0:2]), label.name, fill=label.fontcolor,
-                       font=label.font)
-
-    def _draw_icon(self, icon, icon_point):
+    @staticmethod
+    def _icon_file(icon):
         if os.path.isfile(str(os.path.dirname(os.path.abspath(__file__))) + '/icons/' + icon):
-            im = Image.open(str(os.path.dirname(os.path.abspath(__file__))) + '/icons/' + icon)
-        else:
-            im = Image.open(icon)
-        im.convert("RGBA")
-        self.image.paste(im, (icon_point[0], icon_point[1]), mask=im)
-        im.close()
+            return str(os.path.dirname(os.path.abspath(__file__))) + '/icons/' + icon
+        return icon
 
     def draw_arrows(self):
         for link in self.links:
@@ -355,40 +848,176 @@ class Map(object):
             self._draw_polygon(link.output_points, link.outcolor)
             log.debug('Draw arrows')
 
-    def draw_labels(self):
-        """ Draw labels method"""
-        if self.nodes:
-            for node in self.nodes:
-                if node.label_obj:
-                    self._draw_label(node.label_obj)
+    def draw_link_labels(self):
         if self.links:
             for link in self.links:
                 self._draw_label(link.in_label)
                 self._draw_label(link.out_label)
-        log.debug('Draw labels')
 
-    def draw_icons(self):
-        if self.nodes is not None:
-            for node in self.nodes:
-                if node.icon:
-                    self._draw_icon(node.icon, node.icon_point)
-                    log.debug('Draw icons')
+    def static_key(self):
+        """ Hash of everything drawn in static layers: map size, background, legend, icons and node labels """
+        key = [self.len_x, self.len_y, self.bgcolor, self.table.key() if self.table else None]
+        for node in self.nodes or ():
+            if node.icon:
+                icon_file = self._icon_file(node.icon)
+                key.append((icon_file, os.path.getmtime(icon_file), tuple(node.icon_point)))
+            if node.label_obj:
+                key.append(node.label_obj.key())
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def fingerprint(self):
+        """ Hash of map content without date time: static layers, arrows and link labels """
+        key = [self.static_key(), self.table.dt if self.table else None, self.image_format.key()]
+        for link in self.links or ():
+            key.append((link.input_points, link.output_points, link.incolor, link.outcolor,
+                        link.in_label.key() if link.in_label else None,
+                        link.out_label.key() if link.out_label else None))
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def static_layers(self, key=None):
+        """ Static layers of map, kept by map while static_key is not changed:
+        base - background and legend without date time, drawn under arrows,
+        overlay and mask - icons and node labels, pasted over arrows
+        :param key: static_key of map
+        :return: tuple (base, overlay, mask)"""
+        key = key or self.static_key()
+        if self.static is not None and self.static[0] == key:
+            return self.static[1:]
+        self.static = None
+
+        base = self.create_image(self.len_x, self.len_y)
+        if self.table:
+            self.table.draw_table(ImageDraw.Draw(base), dt=False)
+
+        overlay = Image.new('RGBA', (self.len_x, self.len_y), (0, 0, 0, 0))
+        for node in self.nodes or ():
+            if node.icon:
+                im = IconCache().get(self._icon_file(node.icon))
+                x, y = node.icon_point[0:2]
+                source = (max(0, -x), max(0, -y))
+                if x + source[0] < self.len_x and y + source[1] < self.len_y:
+                    overlay.alpha_composite(im, dest=(x + source[0], y + source[1]), source=source)
+        draw_overlay = ImageDraw.Draw(overlay)
+        for node in self.nodes or ():
+            if node.label_obj:
+                self._draw_label(node.label_obj, draw=draw_overlay)
+        mask = overlay.getchannel('A')
+
+        self.static = (key, base, overlay, mask)
+        log.debug('Static layers created %s', key)
+        return base, overlay, mask
 
     def do(self):
-        if self.table:
-            self.table.draw_table(self.draw)
-        self.draw_arrows()
-        self.draw_icons()
-        self.draw_labels()
+        """ Draw map: static base, date time, arrows, static icons and node labels, link labels.
+        If static layers are not changed since previous frame, only regions of changed links are redrawn """
+        with self.phases('draw'):
+            key = self.static_key()
+            base, overlay, mask = self.static_layers(key)
+            dirty = [box for link in self.links or () for box in link.dirty]
+            area = sum((box[2] - box[0]) * (box[3] - box[1]) for box in dirty)
+            if self.frame_key == key and len(self.extents) == len(self.links or ()) and \
+                    area <= self.redraw_limit * self.len_x * self.len_y:
+                self._redraw(dirty, base, overlay, mask)
+            else:
+                self.image = base.copy()
+                self.draw = ImageDraw.Draw(self.image)
+                if self.table and self.table.dt:
+                    self.table.draw_datetime(self.draw)
+                self.draw_arrows()
+                self.image.paste(overlay, (0, 0), mask=mask)
+                self.draw_link_labels()
+                self._index()
+            for link in self.links or ():
+                link.dirty = []
+            self.frame_key = key
+
+    def _parts(self, link):
+        """ Boxes of link parts in draw order: input arrow, output arrow, input label, output label """
+        return (link.arrow_bbox(link.input_points), link.arrow_bbox(link.output_points), link.in_label.bbox(),
+                link.out_label.bbox())
+
+    def _index(self):
+        """ Index boxes of links parts for redraw """
+        self.grid = Grid()
+        self.extents = []
+        for i, link in enumerate(self.links or ()):
+            boxes = self._parts(link)
+            self.extents.append(list(boxes))
+            for part, box in enumerate(boxes):
+                self.grid.add((i, part), box)
+
+    def _redraw(self, dirty, base, overlay, mask):
+        """ Redraw regions of previous frame in cells of grid: links parts in cells are drawn on copy of base,
+        cells are copied to frame """
+        for i, link in enumerate(self.links or ()):
+            if link.dirty:
+                for part, box in enumerate(self._parts(link)):
+                    extent = self.extents[i][part]
+                    if box[0] < extent[0] or box[1] < extent[1] or box[2] > extent[2] or box[3] > extent[3]:
+                        extent = (min(box[0], extent[0]), min(box[1], extent[1]), max(box[2], extent[2]),
+                                  max(box[3], extent[3]))
+                        self.extents[i][part] = extent
+                        self.grid.add((i, part), extent)
+        if self.table and self.table.dt:
+            dirty.append(self.table.datetime_bbox())
+        cells = set()
+        for box in dirty:
+            box = (max(0, box[0]), max(0, box[1]), min(self.len_x, box[2]), min(self.len_y, box[3]))
+            if box[0] < box[2] and box[1] < box[3]:
+                cells.update(self.grid.cells_of(box))
+        if not cells:
+            return
+
+        parts = sorted(self.grid.query(cells))
+        boxes = []
+        for cell in sorted(cells):
+            box = self.grid.cell_box(cell)
+            boxes.append((box[0], box[1], min(self.len_x, box[2]), min(self.len_y, box[3])))
+
+        work = base.copy()
+        draw = ImageDraw.Draw(work)
+        if self.table and self.table.dt:
+            self.table.draw_datetime(draw)
+        for i, part in parts:
+            if part == 0:
+                self._draw_polygon(self.links[i].input_points, self.links[i].incolor, draw=draw)
+            elif part == 1:
+                self._draw_polygon(self.links[i].output_points, self.links[i].outcolor, draw=draw)
+        for box in boxes:
+            work.paste(overlay.crop(box), box[0:2], mask=mask.crop(box))
+        for i, part in parts:
+            if part == 2:
+                self._draw_label(self.links[i].in_label, draw=draw)
+            elif part == 3:
+                self._draw_label(self.links[i].out_label, draw=draw)
+        for box in boxes:
+            self.image.paste(work.crop(box), box[0:2])
+        work.close()
+        log.debug('Redraw %s parts of links in %s cells', len(parts), len(cells))
 
     def show(self):
         self.image.show()
 
-    def save_img(self, path=str()):
+    def encode(self):
+        """ Encode the image in map image format
+        @return: bytes
+        """
+        with self.phases('encode'):
+            colors = self.links[0].palette if self.links else ()
+            img = BytesIO()
+            self.image_format.save(self.image, img, bgcolor=self.bgcolor, colors=colors)
+            return img.getvalue()
+
+    def save_img(self, path=str(), data=None):
         """
-        Save the image to the file path
+        Save the image to the file path, file is written to temporary file and renamed
         @param path: path to the file
+        @param data: encoded image, default self.encode()
+        @return: size of file in bytes
         """
-        self.image.save(path, "PNG")
-        log.debug('save img {}'.format(path))
-        self.image.close()
+        if data is None:
+            data = self.encode()
+        with self.phases('save'):
+            write_atomic(path, data)
+            log.debug('save img {}'.format(path))
+            return len(data)
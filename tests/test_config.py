@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# __author__ = 'maximus'
+
+import base64
+import shutil
+import tempfile
+from io import BytesIO
+from unittest import TestCase, mock
+from PIL import Image
+from config import ConfigCreate
+from zabbix import ZabbixAgent, ZabbixCache
+
+
+class FakeScanAPI(object):
+    """ Zabbix API with one map: 3 hosts, 1 hostgroup, 1 image element """
+    def __init__(self, *args, **kwargs):
+        self.calls = []
+        self.auth = 'token'
+        img = BytesIO()
+        Image.new('RGBA', (48, 24)).save(img, 'PNG')
+        self.image_b64 = base64.b64encode(img.getvalue()).decode()
+
+    def __getattr__(self, name):
+        api = self
+
+        class Method(object):
+            def __getattr__(self, method):
+                def fn(**params):
+                    api.calls.append(name + '.' + method)
+                    return getattr(api, name + '_' + method)(**params)
+                return fn
+        return Method()
+
+    def host_get(self, hostids=None, output=None):
+        return [{'hostid': hostid, 'host': 'host' + hostid} for hostid in hostids]
+
+    def hostgroup_get(self, groupids=None, output=None):
+        return [{'groupid': groupid, 'name': 'group' + groupid} for groupid in groupids]
+
+    def image_get(self, imageids=None, output=None, select_image=False):
+        if select_image:
+            return [{'imageid': imageid, 'image': self.image_b64} for imageid in imageids]
+        return [{'imageid': imageid, 'name': 'image' + imageid} for imageid in imageids]
+
+
+class TestConfigCreate(TestCase):
+
+    def setUp(self):
+        with mock.patch('zabbix.ZabbixRPC', FakeScanAPI):
+            self.zbx = ZabbixAgent('http://zabbix.example.com', 'admin', 'admin', workers=2)
+        selements = [{'selementid': str(i), 'elementtype': '0', 'elements': [{'hostid': str(i)}],
+                      'iconid_off': '7', 'x': '100', 'y': '100'} for i in range(1, 4)]
+        selements.append({'selementid': '4', 'elementtype': '3', 'elements': [{'groupid': '5'}],
+                          'iconid_off': '8', 'x': '0', 'y': '0'})
+        selements.append({'selementid': '5', 'elementtype': '4', 'elements': [],
+                          'iconid_off': '8', 'x': '0', 'y': '0'})
+        self.map_data = {'name': 'test', 'width': '800', 'height': '600', 'selements': selements,
+                         'links': [{'linkid': '1', 'selementid1': '1', 'selementid2': '4'}]}
+
+    def test_create(self):
+        scan_map = ConfigCreate(self.map_data, self.zbx)
+        scan_map.create()
+        self.assertEqual(scan_map.map_config['node-2'], {'name': 'host2', 'x': 124, 'y': 112})
+        self.assertEqual(scan_map.map_config['node-4']['name'], 'group5')
+        self.assertEqual(scan_map.map_config['node-5']['name'], 'image8')
+        self.assertEqual(scan_map.map_config['link-1']['name1'], 'group5')
+        self.assertEqual(sorted(self.zbx.zbx_api.calls), ['host.get', 'hostgroup.get', 'image.get', 'image.get'])
+
+    def test_cached_icon_sizes(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            for scan, image_calls in ((1, 2), (2, 1)):
+                with mock.patch('zabbix.ZabbixRPC', FakeScanAPI):
+                    zbx = ZabbixAgent('http://zabbix.example.com', 'admin', 'admin',
+                                      cache=ZabbixCache(cache_dir + '/.zbxcache.json', 'http://zabbix.example.com'))
+                scan_maps = ConfigCreate.create_all([self.map_data, dict(self.map_data, name='test2')], zbx)
+                for scan_map in scan_maps:
+                    scan_map.create()
+                self.assertEqual(zbx.zbx_api.calls.count('image.get'), image_calls, scan)
+                self.assertEqual(scan_maps[1].map_config['node-2'], {'name': 'host2', 'x': 124, 'y': 112})
+                self.assertEqual(zbx.cache.get('icons', '7'), [48, 24])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_check_map(self):
+        cfg_dir = tempfile.mkdtemp()
+        try:
+            scan_map = ConfigCreate(self.map_data, self.zbx)
+            scan_map.create()
+            scan_map.map_config['map']['interval'] = 30
+            scan_map.save(cfg_dir)
+            registry = mock.Mock()
+            rescan_map = ConfigCreate(self.map_data, self.zbx, registry=registry)
+            rescan_map.create()
+            rescan_map.check_map(cfg_dir)
+            registry.get.assert_not_called()
+            self.assertEqual(rescan_map.map_config['map']['interval'], 30)
+        finally:
+            shutil.rmtree(cfg_dir)
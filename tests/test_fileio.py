@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# __author__ = 'maximus'
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+from fileio import umask, write_atomic
+from zabbix import ZabbixCache
+
+
+class TestWriteAtomic(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = self.tmp_dir + '/file.json'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_mode(self):
+        write_atomic(self.path, '{}')
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o666 & ~umask())
+        os.chmod(self.path, 0o640)
+        write_atomic(self.path, b'{}')
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o640)
+        with open(self.path) as written:
+            self.assertEqual(written.read(), '{}')
+
+    def test_failed_write(self):
+        write_atomic(self.path, 'old')
+        with mock.patch('fileio.os.replace', side_effect=OSError), self.assertRaises(OSError):
+            write_atomic(self.path, 'new')
+        with open(self.path) as written:
+            self.assertEqual(written.read(), 'old')
+        self.assertEqual(os.listdir(self.tmp_dir), ['file.json'])
+
+    def test_cache_mode(self):
+        cache = ZabbixCache(self.path, 'http://zabbix.example.com')
+        cache.set('items', 'R1\nin[1]', '10')
+        cache.save()
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o666 & ~umask())
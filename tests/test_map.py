@@ -2,10 +2,16 @@
 # -*- coding: utf-8 -*-
 # __author__ = 'maximus'
 
-from unittest import TestCase
-from mapping import Map, Node, Table, Link
+from unittest import TestCase, mock, skipIf
+import fileio
+import mapping
+from mapping import Map, Node, Palette, Table, Link, LinkState, IconCache, FontCache, ImageFormat, LabelPlacer
 import os
 import hashlib
+import shutil
+import tempfile
+from io import BytesIO
+from PIL import Image
 import warnings
 
 
@@ -39,6 +45,9 @@ class TestMap(TestCase):
 
         table = Table(self.font_path_fn, x=700, y=350, dt=False)
         self.new_map = Map([link_a, link_b, link_c, link_d, link_e], [a, b, c, d, e], table=table, len_x=800, len_y=800)
+        self.links = [link_a, link_b, link_c, link_d, link_e]
+        self.nodes = [a, b, c, d, e]
+        self.table = table
 
     def test_map(self):
         warnings.simplefilter("ignore", ResourceWarning)
@@ -48,5 +57,117 @@ class TestMap(TestCase):
         self.assertEqual(self.hash, hashlib.sha256(open(self.img_path + '/test.png', 'rb').read()).hexdigest())
         # self.fail()
 
+    def test_static_layers(self):
+        self.new_map.do()
+        key = self.new_map.static_key()
+        self.assertEqual(self.new_map.static[0], key)
+        base = self.new_map.static[1]
+        image = self.new_map.image.tobytes()
+        self.links[0].data(in_bps=5000000, out_bps=0)
+        self.new_map.do()
+        self.assertIs(self.new_map.static[1], base)
+        self.assertNotEqual(self.new_map.image.tobytes(), image)
+
+        self.nodes[0].label_obj.name = 'host-Z'
+        self.assertNotEqual(self.new_map.static_key(), key)
+        self.new_map.do()
+        self.assertIsNot(self.new_map.static[1], base)
+        self.assertEqual(self.new_map.static[0], self.new_map.static_key())
+
+    def test_icon_cache(self):
+        icon = IconCache().get(self.icon_path + '/Router96.png')
+        self.assertEqual(icon.mode, 'RGBA')
+        self.assertIs(IconCache().get(self.icon_path + '/../icons/Router96.png'), icon)
+        self.assertEqual(self.nodes[0].icon_point, [int(300 - icon.size[0] / 2), int(30 - icon.size[1] / 2)])
+
+    def test_font_cache(self):
+        self.assertIs(self.links[0].in_label.font, self.nodes[0].label_obj.font)
+        self.assertIs(self.table.font, FontCache().get(self.font_path_fn, 12))
+        label = self.nodes[0].label_obj
+        self.assertEqual(label.text_bbox(), label.font.getbbox('host-A'))
+        self.assertIs(label.text_bbox(), label.text_bbox())
+
+    @skipIf(mapping.numpy is None, 'numpy is not installed')
+    def test_calc_points(self):
+        nodes = self.nodes + [Node(self.font_path_fn, self.icon_path, x=x, y=y)
+                              for x, y in ((400, 400), (-20, 613), (1001, 7), (400, 999))]
+        links = [Link(self.font_path_fn, a, b, width=width) for a in nodes for b in nodes for width in (1, 5, 7.5, 15)]
+        points = [(link.input_points, link.output_points, link.input_label_point, link.output_label_point)
+                  for link in links]
+        Link.calc_points(links)
+        calculated = [(link.input_points, link.output_points, link.input_label_point, link.output_label_point)
+                      for link in links]
+        self.assertEqual(points, calculated)
+        self.assertEqual(repr(points), repr(calculated))
+
+    def test_link_state(self):
+        state = LinkState(self.links)
+        state.update([(0, 123345123), (54123456, 114987654), (841123456, 5147987654), (73456852, 987654),
+                      (-10 ** 7, 73456852)])
+        state.apply()
+        self.assertEqual([(link.incolor, link.outcolor, link.in_label.name, link.out_label.name)
+                          for link in self.links[:2]], [('#908C8C', '#0000FF', '0.0K', '123.35M'),
+                                                        ('#FFFF00', '#FF0000', '54.12M', '114.99M')])
+        self.assertEqual((self.links[4].incolor, self.links[4].in_label.name), (None, 'ERR'))
+
+        state = LinkState(self.links, thresholds=(0, 5, 10, 20, 30, 40, 50, 60, 90))
+        state.update([(123345123, 0)] * len(self.links))
+        state.apply()
+        self.assertEqual(self.links[0].incolor, '#8000FF')
+        self.assertEqual(LinkState.legend_text(state.thresholds)[-1], '90-100%')
+
+    def test_redraw(self):
+        self.new_map.do()
+        self.links[1].data(in_bps=54123456, out_bps=114987654)
+        self.assertEqual(self.links[1].dirty, [])
+        self.links[1].data(in_bps=4123456, out_bps=114987654)
+        self.assertEqual(len(self.links[1].dirty), 3)
+        with mock.patch.object(Map, 'draw_arrows') as draw_arrows:
+            self.new_map.do()
+        draw_arrows.assert_not_called()
+        self.assertEqual(self.links[1].dirty, [])
+        full_map = Map(self.links, self.nodes, table=self.table, len_x=800, len_y=800)
+        full_map.do()
+        self.assertEqual(self.new_map.image.tobytes(), full_map.image.tobytes())
+
+    def test_save_img_mode(self):
+        img_dir = tempfile.mkdtemp()
+        path = img_dir + '/test.png'
+        try:
+            self.new_map.save_img(path, data=b'image')
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o666 & ~fileio.umask())
+            os.chmod(path, 0o640)
+            self.new_map.save_img(path, data=b'image')
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+            self.assertEqual(os.listdir(img_dir), ['test.png'])
+        finally:
+            shutil.rmtree(img_dir)
+
+    def test_image_format(self):
+        self.new_map.do()
+        for image_format, mode in ((ImageFormat(mode='P'), 'P'), (ImageFormat(mode='P', palette='fixed'), 'P'),
+                                   (ImageFormat(mode='RGB', compress_level=9), 'RGB'),
+                                   (ImageFormat(fmt='webp'), 'RGBA')):
+            img = BytesIO()
+            image_format.save(self.new_map.image, img, colors=Palette().palette_default)
+            self.assertEqual(Image.open(img).mode, mode)
+        self.assertRaises(ValueError, ImageFormat, fmt='bmp')
+
+    def test_label_placer(self):
+        link = Link(self.font_path_fn, self.nodes[0], self.nodes[4], bandwidth=1000, width=10)
+        link.data(in_bps=1, out_bps=1)
+        self.links.append(link)
+        LabelPlacer(self.nodes).place_links(self.links)
+        for link in self.links:
+            link.data(in_bps=123345123, out_bps=123345123)
+        placer = LabelPlacer(self.nodes)
+        for link in self.links:
+            for label in (link.in_label, link.out_label):
+                self.assertTrue(placer.free(label.bbox()), label.point)
+                placer._add(label.bbox())
+        self.assertEqual(self.links[1].label_points, (self.links[1].input_label_point,
+                                                      self.links[1].output_label_point))
+        self.assertNotEqual(link.in_label.point, link.input_label_point)
+
 if __name__ == '__main__':
     TestMap()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# __author__ = 'maximus'
+
+import json
+import os
+import shutil
+import signal
+import tempfile
+import time
+from unittest import TestCase, mock
+import config
+from config import ConfigLoader
+from benchmark import Benchmark
+from weathermap import WeathermapCLI, read_fingerprint, write_fingerprint
+from zabbixstub import StubData, StubServer, ZabbixStub
+
+
+class TestWeathermapCLI(TestCase):
+
+    def setUp(self):
+        self.data = StubData(links=10, name='stub')
+        self.stub = ZabbixStub(self.data)
+        self.server = StubServer(self.stub).start()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.cfg_path = self.tmp_dir + '/mapcfgs'
+        self.img_path = self.tmp_dir + '/mapimgs'
+        os.mkdir(self.cfg_path)
+        os.mkdir(self.img_path)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_map_upload(self):
+        Benchmark._write_cfg(self.data.config(self.server.url), self.cfg_path + '/stub.yaml')
+        WeathermapCLI(['-m', 'stub.yaml', '-u', '-c', self.cfg_path, '-i', self.img_path])
+        self.assertTrue(os.path.exists(self.img_path + '/stub.png'))
+        self.assertEqual([image['name'] for image in self.data.images.values()], ['Router64', 'stub'])
+        self.assertEqual(self.stub.calls['host.get'], 1)
+        self.assertEqual(self.stub.calls['item.get'], 1)
+
+    def test_map_upload_no_save(self):
+        Benchmark._write_cfg(self.data.config(self.server.url), self.cfg_path + '/stub.yaml')
+        WeathermapCLI(['-m', 'stub.yaml', '-u', '--no-save', '-c', self.cfg_path, '-i', self.img_path])
+        self.assertFalse(os.path.exists(self.img_path + '/stub.png'))
+        self.assertEqual(self.data.images['2']['image'][:4], 'iVBO')
+        WeathermapCLI(['-m', 'stub.yaml', '-c', self.cfg_path, '-i', self.img_path])
+        self.assertTrue(os.path.exists(self.img_path + '/stub.png'))
+        self.assertEqual(sorted(os.listdir(self.img_path)), ['.stub.png.json', 'stub.png'])
+
+    def test_map_upload_no_img_path(self):
+        Benchmark._write_cfg(self.data.config(self.server.url), self.cfg_path + '/stub.yaml')
+        with self.assertLogs('weathermap', level='WARNING') as logs:
+            WeathermapCLI(['-m', 'stub.yaml', '-u', '--no-save', '-c', self.cfg_path, '-i', self.tmp_dir + '/none'])
+        self.assertIn('Map stub.yaml: fingerprint not saved', logs.output[0])
+        self.assertEqual(self.data.images['2']['image'][:4], 'iVBO')
+
+    def test_map_not_changed(self):
+        Benchmark._write_cfg(self.data.config(self.server.url), self.cfg_path + '/stub.yaml')
+        WeathermapCLI(['-m', 'stub.yaml', '-c', self.cfg_path, '-i', self.img_path])
+        WeathermapCLI(['-m', 'stub.yaml', '-u', '-c', self.cfg_path, '-i', self.img_path])
+        self.assertEqual(self.stub.calls['image.create'], 1)
+        mtime = os.path.getmtime(self.img_path + '/stub.png')
+        with self.assertLogs('weathermap', level='INFO') as logs:
+            WeathermapCLI(['-m', 'stub.yaml', '-u', '-c', self.cfg_path, '-i', self.img_path])
+        self.assertIn('Not changed maps: stub.yaml', logs.output[-1])
+        self.assertEqual(os.path.getmtime(self.img_path + '/stub.png'), mtime)
+        self.assertEqual(self.stub.calls['image.create'] + self.stub.calls['image.update'], 1)
+
+        self.data.items['100001']['lastvalue'] = '0'
+        WeathermapCLI(['-m', 'stub.yaml', '-u', '-c', self.cfg_path, '-i', self.img_path])
+        self.assertEqual(self.stub.calls['image.update'], 1)
+
+    def test_write_fingerprint(self):
+        img_path_fn = self.img_path + '/stub.png'
+        write_fingerprint(img_path_fn, 'first', uploaded=True, saved=True)
+        with mock.patch('fileio.os.replace', side_effect=OSError), self.assertRaises(OSError):
+            write_fingerprint(img_path_fn, 'second', uploaded=True, saved=True)
+        self.assertEqual(read_fingerprint(img_path_fn)['fingerprint'], 'first')
+        self.assertEqual(os.listdir(self.img_path), ['.stub.png.json'])
+
+    def test_map_timing(self):
+        Benchmark._write_cfg(self.data.config(self.server.url), self.cfg_path + '/stub.yaml')
+        timing_path = self.tmp_dir + '/timing.json'
+        for run in range(2):
+            WeathermapCLI(['-m', 'stub.yaml', '-u', '-c', self.cfg_path, '-i', self.img_path, '--timing', timing_path])
+        with open(timing_path) as timing_file:
+            rows = [json.loads(line) for line in timing_file]
+        self.assertEqual([row['status'] for row in rows], ['rendered', 'not changed'])
+        self.assertEqual(list(rows[0])[:3], ['time', 'map', 'status'])
+        self.assertLessEqual({'load', 'login', 'fetch', 'geometry', 'state', 'draw', 'encode', 'save', 'upload'},
+                             set(rows[0]))
+        self.assertNotIn('draw', rows[1])
+        self.assertAlmostEqual(rows[0]['total'], sum(value for key, value in rows[0].items()
+                                                     if key not in ('time', 'map', 'status', 'total')), places=3)
+
+    def test_map_metrics(self):
+        Benchmark._write_cfg(self.data.config(self.server.url), self.cfg_path + '/stub.yaml')
+        metrics_path = self.tmp_dir + '/weathermap.metrics'
+        argv = ['-m', 'stub.yaml', '-u', '-c', self.cfg_path, '-i', self.img_path, '--metrics', metrics_path]
+        WeathermapCLI(argv)
+        with open(metrics_path) as metrics_file:
+            lines = metrics_file.read().splitlines()
+        self.assertEqual(lines[0], '- weathermap.discovery "{\\"data\\":[{\\"{#MAP}\\":\\"stub\\"}]}"')
+        values = dict(line.split()[1:] for line in lines[1:])
+        self.assertEqual((values['weathermap.skipped[stub]'], values['weathermap.failed[stub]']), ('0', '0'))
+        self.assertEqual(values['weathermap.links[stub]'], '10')
+        self.assertEqual(values['weathermap.links.failed[stub]'], '0')
+        self.assertEqual(int(values['weathermap.image.bytes[stub]']), os.path.getsize(self.img_path + '/stub.png'))
+        self.assertGreater(float(values['weathermap.render.time[stub]']),
+                           float(values['weathermap.fetch.time[stub]']))
+
+        WeathermapCLI(argv)
+        with open(metrics_path) as metrics_file:
+            values = dict(line.split()[1:] for line in metrics_file.read().splitlines()[1:])
+        self.assertEqual(values['weathermap.skipped[stub]'], '1')
+        self.assertNotIn('weathermap.image.bytes[stub]', values)
+
+    def test_failed_links(self):
+        cfg_dict = self.data.config(self.server.url)
+        cfg_dict['link-1']['itemout'] = None
+        cfg_dict['link-2'].update(hostname=None, itemin=None, itemout=None)
+        Benchmark._write_cfg(cfg_dict, self.cfg_path + '/stub.yaml')
+        cfg = ConfigLoader(self.cfg_path + '/stub.yaml')
+        self.assertEqual(cfg.failed_links(), 9)
+        cfg.fetch()
+        self.assertEqual(cfg.failed_links(), 0)
+        cfg.items_data[(cfg_dict['link-3']['hostname'], cfg_dict['link-3']['itemin'])] = -10 ** 9
+        self.assertEqual(cfg.failed_links(), 1)
+
+    def test_map_cost(self):
+        Benchmark._write_cfg(self.data.config(self.server.url), self.cfg_path + '/stub.yaml')
+        argv = ['-m', 'stub.yaml', '-u', '-c', self.cfg_path, '-i', self.img_path]
+        with mock.patch('builtins.print') as output:
+            WeathermapCLI(argv + ['--dry-run', '--cost'])
+        self.assertEqual(sum(self.stub.calls.values()), 0)
+        table = output.call_args_list[1][0][0]
+        self.assertEqual([line.split()[:2] for line in table.splitlines()[1:]],
+                         [['user.login', '1'], ['user.logout', '1'], ['host.get', '1'], ['item.get', '1'],
+                          ['image.get', '1'], ['image.create', '1'], ['total', '6']])
+
+        with self.assertLogs('weathermap', level='INFO') as logs:
+            WeathermapCLI(argv)
+        self.assertIn('Map stub.yaml: Zabbix API 5 calls', logs.output[-1])
+        self.assertIn('host.get 1, item.get 1, image.get 1, image.create 1', logs.output[-1])
+
+    def test_compiled_config(self):
+        Benchmark._write_cfg(self.data.config(self.server.url), self.cfg_path + '/stub.yaml')
+        cfg = ConfigLoader(self.cfg_path + '/stub.yaml')
+        cfg.create_map(self.root_path + '/fonts/DejaVuSansMono.ttf', self.root_path + '/icons')
+        self.assertTrue(os.path.exists(self.cfg_path + '/.stub.yaml.compiled.json'))
+        with mock.patch('config.yaml3ed.safe_load') as safe_load:
+            warm = ConfigLoader(self.cfg_path + '/stub.yaml')
+        safe_load.assert_not_called()
+        self.assertEqual(warm.cfg_dict, cfg.cfg_dict)
+        with mock.patch('config.Link.calc_points') as calc_points:
+            warm.create_map(self.root_path + '/fonts/DejaVuSansMono.ttf', self.root_path + '/icons')
+        calc_points.assert_not_called()
+        self.assertEqual(warm.obj_links['link-1'].input_points, cfg.obj_links['link-1'].input_points)
+
+        with open(self.cfg_path + '/stub.yaml', 'a') as cfg_file:
+            cfg_file.write('\n')
+        with mock.patch('config.yaml3ed.safe_load', wraps=config.yaml3ed.safe_load) as safe_load:
+            ConfigLoader(self.cfg_path + '/stub.yaml')
+        safe_load.assert_called_once()
+
+        for content in ('{"key": [', '{"points": 1}', '[1, 2]'):
+            with open(self.cfg_path + '/.stub.yaml.compiled.json', 'w') as compiled_file:
+                compiled_file.write(content)
+            with mock.patch('config.yaml3ed.safe_load', wraps=config.yaml3ed.safe_load) as safe_load:
+                self.assertEqual(ConfigLoader(self.cfg_path + '/stub.yaml').cfg_dict, cfg.cfg_dict)
+            safe_load.assert_called_once()
+
+    def test_config_reload(self):
+        cfg_dict = self.data.config(self.server.url)
+        Benchmark._write_cfg(cfg_dict, self.cfg_path + '/stub.yaml')
+        cfg = ConfigLoader(self.cfg_path + '/stub.yaml')
+        fonts, icons = self.root_path + '/fonts/DejaVuSansMono.ttf', self.root_path + '/icons'
+        cfg.create_map(fonts, icons).do()
+        self.assertFalse(cfg.reload())
+
+        nodes, links = dict(cfg.obj_nodes), dict(cfg.obj_links)
+        moved = cfg_dict['link-1']['node1']
+        cfg_dict[moved]['x'] += 10
+        cfg_dict['link-2']['itemin'] = cfg_dict['link-2']['itemout']
+        Benchmark._write_cfg(cfg_dict, self.cfg_path + '/stub.yaml')
+        os.utime(self.cfg_path + '/stub.yaml', ns=(0, 0))
+        self.assertTrue(cfg.reload())
+        new_map = cfg.create_map(fonts, icons)
+        for link, obj in cfg.obj_links.items():
+            rebuilt = moved in (cfg_dict[link]['node1'], cfg_dict[link]['node2'])
+            self.assertEqual(obj is not links[link], rebuilt, link)
+        self.assertEqual([node for node in nodes if cfg.obj_nodes[node] is not nodes[node]], [moved])
+        self.assertEqual(cfg.obj_nodes[moved].x, cfg_dict[moved]['x'])
+        self.assertEqual(cfg.obj_links['link-2'].in_label.name, cfg.obj_links['link-2'].out_label.name)
+        new_map.do()
+
+        with open(self.cfg_path + '/stub.yaml', 'a') as cfg_file:
+            cfg_file.write('link-1: [\n')
+        with mock.patch('builtins.print'):
+            cfg.reload()
+        self.assertIs(cfg.create_map(fonts, icons), new_map)
+
+    def test_map_daemon(self):
+        cfg_dict = self.data.config(self.server.url)
+        cfg_dict['map']['interval'] = 10
+        Benchmark._write_cfg(cfg_dict, self.cfg_path + '/stub.yaml')
+        broken = self.data.config(self.server.url)
+        broken['link-1']['hostname'] = 'unknown'
+        Benchmark._write_cfg(broken, self.cfg_path + '/broken.yaml')
+        clock = {'now': 0.0, 'expired': False}
+
+        def sleep(seconds):
+            clock['now'] += seconds
+            if clock['now'] >= 25 and not os.path.exists(self.cfg_path + '/late.yaml'):
+                Benchmark._write_cfg(self.data.config(self.server.url), self.cfg_path + '/late.yaml')
+            if clock['now'] >= 35 and not clock['expired']:
+                clock['expired'] = True
+                self.stub.expire()
+            if clock['now'] > 60:
+                os.kill(os.getpid(), signal.SIGTERM)
+
+        fake_time = mock.Mock(wraps=time)
+        fake_time.monotonic.side_effect = lambda: clock['now']
+        fake_time.sleep.side_effect = sleep
+        with mock.patch('weathermap.time', fake_time), self.assertLogs('weathermap', level='INFO') as logs:
+            WeathermapCLI(['-m', 'stub.yaml', 'broken.yaml', 'late.yaml', '--daemon', '--force', '--interval', '30',
+                           '-c', self.cfg_path, '-i', self.img_path, '--metrics', self.tmp_dir + '/weathermap.metrics'])
+        output = '\n'.join(logs.output)
+        self.assertEqual(output.count('Map stub.yaml rendered'), 7)
+        self.assertEqual(output.count('Map broken.yaml failed'), 3)
+        self.assertEqual(output.count('Map late.yaml: config not loaded'), 1)
+        self.assertEqual(output.count('Map late.yaml rendered'), 2)
+        self.assertIn('Daemon stopped', logs.output[-1])
+        self.assertEqual(self.stub.calls['user.login'], 2)
+        self.assertEqual(self.stub.calls['user.logout'], 1)
+        self.assertIs(signal.getsignal(signal.SIGTERM), signal.SIG_DFL)
+        with open(self.tmp_dir + '/weathermap.metrics') as metrics_file:
+            lines = metrics_file.read().splitlines()
+        discovery = json.loads(json.loads(lines[0].split(None, 2)[2]))
+        self.assertEqual(sorted(item['{#MAP}'] for item in discovery['data']), ['broken', 'late', 'stub'])
+        self.assertEqual(len({line.split()[1].split('[')[1] for line in lines[1:]}), 1)
+
+    def test_workers(self):
+        for option in ('-w', '-j'):
+            with mock.patch('sys.stderr'), self.assertRaises(SystemExit) as exc:
+                WeathermapCLI(['-m', 'stub.yaml', option, '0', '-c', self.cfg_path])
+            self.assertEqual(exc.exception.code, 2)
+        with mock.patch('sys.stderr'), self.assertRaises(SystemExit) as exc:
+            WeathermapCLI(['-m', 'stub.yaml', '--daemon', '-j', '2', '-c', self.cfg_path])
+        self.assertEqual(exc.exception.code, 2)
+
+    def test_map_jobs(self):
+        Benchmark._write_cfg(self.data.config(self.server.url), self.cfg_path + '/stub.yaml')
+        cfg = self.data.config(self.server.url)
+        cfg['map']['name'] = 'broken'
+        cfg['link-1']['hostname'] = 'unknown'
+        Benchmark._write_cfg(cfg, self.cfg_path + '/broken.yaml')
+        with self.assertLogs('weathermap', level='ERROR') as logs:
+            with self.assertRaises(SystemExit) as exc:
+                WeathermapCLI(['-m', 'stub.yaml', 'broken.yaml', '-u', '-j', '2', '-c', self.cfg_path,
+                               '-i', self.img_path])
+        self.assertEqual(exc.exception.code, 1)
+        self.assertIn('Failed maps: broken.yaml', logs.output[-1])
+        self.assertTrue(os.path.exists(self.img_path + '/stub.png'))
+        self.assertFalse(os.path.exists(self.img_path + '/broken.png'))
+        self.assertEqual(self.stub.calls['image.create'], 1)
+
+    def test_map_scan(self):
+        WeathermapCLI(['-s', 'stub', '-z', self.server.url, '-l', 'admin', '-p', 'zabbix', '-c', self.cfg_path])
+        self.assertTrue(os.path.exists(self.cfg_path + '/stub.yaml'))
+        self.assertEqual(self.stub.calls['image.get'], 1)
+
+    def test_map_scan_all(self):
+        self.data.maps['2'] = dict(self.data.maps['1'], sysmapid='2', name='stub2')
+        Benchmark._write_cfg(self.data.config(self.server.url), self.cfg_path + '/stub.yaml')
+        with mock.patch('config.ConfigCreate.setup_yaml', wraps=config.ConfigCreate.setup_yaml) as setup_yaml:
+            WeathermapCLI(['--scan-all', '-z', self.server.url, '-l', 'admin', '-p', 'zabbix', '-c', self.cfg_path])
+        self.assertEqual(setup_yaml.call_count, 2)
+        self.assertEqual(self.stub.calls['map.get'], 1)
+        self.assertEqual(self.stub.calls['host.get'], 1)
+        self.assertEqual(self.stub.calls['image.get'], 1)
+        stub = ConfigLoader(self.cfg_path + '/stub.yaml').cfg_dict
+        stub2 = ConfigLoader(self.cfg_path + '/stub2.yaml').cfg_dict
+        self.assertEqual(stub['link-1']['itemin'], 'ifHCInOctets[0]')
+        self.assertEqual(stub2['link-1']['itemin'], '')
+        self.assertEqual(stub2['node-1'], {'name': 'host-0', 'x': 100, 'y': 86})
+        self.assertEqual(stub['node-1']['label'], 'H0')
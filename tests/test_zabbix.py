@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# __author__ = 'maximus'
+
+import json
+import os
+import tempfile
+from unittest import TestCase, mock
+from pyzabbix import ZabbixAPIException
+from zabbix import ZabbixAgent, ZabbixCache, ZabbixRegistry, ZbxException
+
+
+class FakeMethod(object):
+    def __init__(self, api, name):
+        self.api = api
+        self.name = name
+
+    def __getattr__(self, method):
+        def fn(**params):
+            self.api.calls.append(self.name + '.' + method)
+            return getattr(self.api, self.name + '_' + method)(**params)
+        return fn
+
+
+class FakeZabbixAPI(object):
+    """ Zabbix API with hosts R1, R2 and interface counters """
+    def __init__(self, *args, **kwargs):
+        self.calls = ['user.login']
+        self.auth = 'token'
+        self.hosts = {'1': 'R1', '2': 'R2'}
+        self.images = {}
+        self.items = [{'itemid': str(10 + i), 'hostid': hostid, 'key_': key, 'lastvalue': str(1000 * (i + 1))}
+                      for i, (hostid, key) in enumerate([(h, k) for h in ('1', '2')
+                                                         for k in ('in[1]', 'out[1]', 'in[2]', 'out[2]')])]
+
+    def __getattr__(self, name):
+        return FakeMethod(self, name)
+
+    def api_version(self):
+        return '3.4.0'
+
+    def user_logout(self):
+        return True
+
+    def host_get(self, filter=None, output=None):
+        return [{'hostid': hostid, 'name': name} for hostid, name in self.hosts.items() if name in filter['name']]
+
+    def item_get(self, hostids=None, itemids=None, filter=None, output=None):
+        if itemids is not None:
+            return [dict(item) for item in self.items if item['itemid'] in itemids]
+        return [dict(item) for item in self.items if item['hostid'] in hostids and item['key_'] in filter['key_']]
+
+    def image_get(self, filter=None, output=None):
+        return [{'imageid': imageid} for imageid, image in self.images.items() if image['name'] == filter['name']]
+
+    def image_create(self, name=None, imagetype=None, image=None):
+        imageid = str(100 + len(self.images))
+        self.images[imageid] = {'name': name, 'image': image}
+        return {'imageids': [imageid]}
+
+    def image_update(self, imageid=None, image=None):
+        if imageid not in self.images:
+            raise ZabbixAPIException('No permissions to referred object or it does not exist!')
+        self.images[imageid]['image'] = image
+        return {'imageids': [imageid]}
+
+
+class TestZabbixAgent(TestCase):
+
+    def setUp(self):
+        with mock.patch('zabbix.ZabbixRPC', FakeZabbixAPI):
+            self.zbx = ZabbixAgent('http://zabbix.example.com', 'admin', 'admin')
+
+    def test_get_items_data(self):
+        data = self.zbx.get_items_data([('R1', 'in[1]'), ('R1', 'out[1]'), ('R2', 'in[2] + in[1]')])
+        self.assertEqual(data, {('R1', 'in[1]'): 1000, ('R1', 'out[1]'): 2000, ('R2', 'in[2] + in[1]'): 12000})
+        self.assertEqual(self.zbx.zbx_api.calls, ['user.login', 'host.get', 'item.get'])
+
+    def test_get_items_data_parallel(self):
+        with mock.patch('zabbix.ZabbixRPC', FakeZabbixAPI):
+            zbx = ZabbixAgent('http://zabbix.example.com', 'admin', 'admin', workers=4,
+                              cache=ZabbixCache(os.devnull, 'http://zabbix.example.com'))
+        zbx.chunk_size = 1
+        zbx.cache.save = lambda: None
+        for itemid, key in (('10', 'R1\nin[1]'), ('11', 'R1\nout[1]')):
+            zbx.cache.set('items', key, itemid)
+        data = zbx.get_items_data([('R1', 'in[1]'), ('R1', 'out[1]'), ('R2', 'in[2]')])
+        self.assertEqual(data, {('R1', 'in[1]'): 1000, ('R1', 'out[1]'): 2000, ('R2', 'in[2]'): 7000})
+        self.assertEqual(sorted(zbx.zbx_api.calls), ['host.get', 'item.get', 'item.get', 'item.get', 'user.login'])
+
+    def test_get_items_data_not_found(self):
+        with self.assertRaises(ZbxException):
+            self.zbx.get_items_data([('R3', 'in[1]')])
+        with self.assertRaises(ZbxException):
+            self.zbx.get_items_data([('R1', 'in[3]')])
+
+
+class TestZabbixCache(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_path = self.tmp_dir.name + '/.zbxcache.json'
+        self.items = [('R1', 'in[1]'), ('R2', 'out[2]')]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def agent(self):
+        with mock.patch('zabbix.ZabbixRPC', FakeZabbixAPI):
+            return ZabbixAgent('http://zabbix.example.com', 'admin', 'admin',
+                               cache=ZabbixCache(self.cache_path, 'http://zabbix.example.com'))
+
+    def test_cached_itemids(self):
+        data = self.agent().get_items_data(self.items)
+        self.assertTrue(os.path.exists(self.cache_path))
+        zbx = self.agent()
+        self.assertEqual(zbx.get_items_data(self.items), data)
+        self.assertEqual(zbx.zbx_api.calls, ['user.login', 'item.get'])
+
+    def test_missing_itemid(self):
+        self.agent().get_items_data(self.items)
+        zbx = self.agent()
+        zbx.zbx_api.items[0]['itemid'] = '99'
+        self.assertEqual(zbx.get_items_data(self.items), {('R1', 'in[1]'): 1000, ('R2', 'out[2]'): 8000})
+        self.assertEqual(zbx.zbx_api.calls, ['user.login', 'item.get', 'host.get', 'item.get'])
+        self.assertEqual(zbx.cache.get('items', 'R1\nin[1]'), '99')
+
+    def test_upload_image(self):
+        zbx = self.agent()
+        self.assertEqual(zbx.upload_image('map', 'aW1n'), '100')
+        self.assertEqual(zbx.upload_image('map', 'aW1n'), '100')
+        self.assertEqual(zbx.upload_image('map', 'aW1nMg=='), '100')
+        self.assertEqual(zbx.zbx_api.calls, ['user.login', 'image.get', 'image.create', 'image.update'])
+        del zbx.zbx_api.images['100']
+        self.assertEqual(zbx.upload_image('map', 'aW1n'), '100')
+        self.assertEqual(zbx.zbx_api.calls[4:], ['image.update', 'image.get', 'image.create'])
+        self.assertEqual(zbx.zbx_api.images['100']['image'], 'aW1n')
+
+    def test_ttl(self):
+        cache = ZabbixCache(self.cache_path, 'http://zabbix.example.com', ttl=0)
+        cache.set('items', 'R1\nin[1]', '10')
+        self.assertIsNone(cache.get('items', 'R1\nin[1]'))
+
+        cache = ZabbixCache(self.cache_path, 'http://zabbix.example.com', ttl=60)
+        cache.set('items', 'R1\nin[1]', '10')
+        cache.set('items', 'R2\nout[2]', '20')
+        cache.entries['items']['R2\nout[2]'][1] -= 61
+        cache.save()
+        with open(self.cache_path) as cache_file:
+            self.assertEqual(list(json.load(cache_file)['http://zabbix.example.com']['items']), ['R1\nin[1]'])
+
+    def test_cache_not_saved(self):
+        zbx = self.agent()
+        with mock.patch('zabbix.write_atomic', side_effect=PermissionError(13, 'Permission denied')):
+            with self.assertLogs('zabbix', level='WARNING'):
+                data = zbx.get_items_data(self.items)
+        self.assertEqual(data, {('R1', 'in[1]'): 1000, ('R2', 'out[2]'): 8000})
+        self.assertTrue(zbx.cache.changed)
+
+
+class TestZabbixRegistry(TestCase):
+
+    def test_shared_agent(self):
+        registry = ZabbixRegistry()
+        with mock.patch('zabbix.ZabbixRPC', FakeZabbixAPI):
+            zbx = registry.get('http://zabbix.example.com', 'admin', 'admin')
+            self.assertIs(registry.get('http://zabbix.example.com', 'admin', 'admin'), zbx)
+            self.assertIsNot(registry.get('http://zabbix.example.com', 'guest', 'guest'), zbx)
+        registry.logout()
+        self.assertEqual(zbx.zbx_api.calls, ['user.login', 'user.logout'])
+        self.assertEqual(registry.agents, {})
+
+    def test_workers(self):
+        self.assertRaises(ValueError, ZabbixRegistry, workers=0)
@@ -3,16 +3,124 @@
 # __author__ = 'maximus'
 
 import argparse
+import functools
+import heapq
+import json
 import logging
 import os
+import signal
 import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 from config import ConfigLoader, ConfigCreate
-from zabbix import ZabbixAgent
+from fileio import write_atomic
+from mapping import Phases
+from zabbix import ZabbixRegistry
+
+log = logging.getLogger(__name__)
+
+
+def positive_int(value):
+    """ argparse type of options that must be 1 or more """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError('%s is not a positive integer' % value)
+    return number
+
+
+def render_map(cfg: ConfigLoader, font_path_fn: str, icon_path: str, img_path_fn: str, upload=False, force=False,
+               save=True):
+    """ Draw map with fetched items data, encode image and save it, runs in worker process with --jobs.
+    Map is not drawn if its fingerprint is equal to fingerprint of saved and uploaded image
+    :param save: save image to img_path_fn
+    :return: tuple (map fingerprint, encoded image, times of phases), fingerprint and image are None
+    if map is not changed """
+    map_obj = cfg.create_map(font_path_fn, icon_path)
+    fingerprint = map_obj.fingerprint()
+    last = read_fingerprint(img_path_fn)
+    if not force and last.get('fingerprint') == fingerprint and (last.get('uploaded') or not upload) and \
+            (not save or last.get('saved', True) and os.path.exists(img_path_fn)):
+        return None, None, cfg.phases.times
+    map_obj.do()
+    # map_obj.show()
+    start = time.perf_counter()
+    image = map_obj.encode()
+    log.info('Image %s: %s bytes, encoded in %.3f sec', os.path.basename(img_path_fn), len(image),
+             time.perf_counter() - start)
+    if save:
+        map_obj.save_img(img_path_fn, image)
+    return fingerprint, image, cfg.phases.times
+
+
+def fingerprint_path(img_path_fn: str):
+    return os.path.dirname(img_path_fn) + '/.' + os.path.basename(img_path_fn) + '.json'
+
+
+def read_fingerprint(img_path_fn: str) -> dict:
+    try:
+        with open(fingerprint_path(img_path_fn)) as fingerprint_file:
+            return json.load(fingerprint_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_fingerprint(img_path_fn: str, fingerprint: str, uploaded: bool, saved: bool):
+    write_atomic(fingerprint_path(img_path_fn),
+                 json.dumps({'fingerprint': fingerprint, 'uploaded': uploaded, 'saved': saved}))
+
+
+def sender_key(key, param):
+    """ Zabbix item key with one parameter, parameter is quoted if needed """
+    if any(char in param for char in ',[]" ') or param.startswith('"'):
+        param = '"' + param.replace('"', '\\"') + '"'
+    return '{}[{}]'.format(key, param)
+
+
+def sender_line(key, value):
+    """ Line of zabbix_sender input file, host - is host from zabbix_sender config or -s """
+    fields = []
+    for field in (key, str(value)):
+        if any(char in field for char in ' \t"\\') or not field:
+            field = '"' + field.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        fields.append(field)
+    return '- ' + ' '.join(fields)
+
+
+def timing_table(rows, columns):
+    """ Table of render phases
+    :param rows: list of dict from WeathermapCLI._report
+    :param columns: phases in order of columns
+    :return: str """
+    header = ['map', 'status'] + [col for col in columns if any(col in row for row in rows)] + ['total']
+    lines = [[row[col] if col in ('map', 'status') else ('{:.3f}'.format(row[col]) if col in row else '-')
+              for col in header] for row in rows]
+    widths = [max(len(col), *(len(line[i]) for line in lines)) for i, col in enumerate(header)]
+    return '\n'.join('  '.join(value.rjust(widths[i]) for i, value in enumerate(line)) for line in [header] + lines)
+
+
+def cost_table(api_calls, interval):
+    """ Table of Zabbix API calls of one run
+    :param api_calls: ApiCalls
+    :param interval: seconds between runs
+    :return: str """
+    header = ['method', 'calls', 'calls/min', 'sent B', 'received B', 'sent B/min', 'received B/min']
+    lines = []
+    for method, (calls, _, sent, received) in list(api_calls.methods.items()) + [('total', api_calls.total())]:
+        lines.append([method, str(calls), '{:.1f}'.format(calls * 60 / interval), str(sent), str(received),
+                      str(int(sent * 60 / interval)), str(int(received * 60 / interval))])
+    widths = [max(len(col), *(len(line[i]) for line in lines)) for i, col in enumerate(header)]
+    return '\n'.join('  '.join(value.ljust(widths[i]) if i == 0 else value.rjust(widths[i])
+                               for i, value in enumerate(line)) for line in [header] + lines)
 
 
 class WeathermapCLI(object):
-    def __init__(self):
+    # render phases in order of timing table columns
+    phases = ('load', 'login', 'fetch', 'geometry', 'state', 'draw', 'encode', 'save', 'upload')
+
+    def __init__(self, argv=None):
         self.root_path = str(os.path.dirname(os.path.abspath(__file__)))
         self.font_path = self.root_path + '/fonts'
         self.font_path_fn = self.root_path + '/fonts/DejaVuSansMono.ttf'
@@ -28,18 +136,48 @@ class WeathermapCLI(object):
         self.parser.add_argument('-m', '--map', nargs='+', action='store', type=str, help='Config file names')
         self.parser.add_argument('-i', '--img', action='store', type=str, help='Image path')
         self.parser.add_argument('-u', '--upload', action='store_true', help='Image upload to zabbix')
+        self.parser.add_argument('--force', action='store_true', help='Save and upload images of not changed maps')
+        self.parser.add_argument('--no-save', action='store_true', help='Do not save images to image path, with -u')
+        self.parser.add_argument('-j', '--jobs', action='store', type=positive_int, default=1,
+                                 help='Number of processes to render maps, not with --daemon')
+        self.parser.add_argument('--daemon', action='store_true', help='Render maps in loop, do not exit')
+        self.parser.add_argument('--interval', action='store', type=int, default=60,
+                                 help='Default map render interval in daemon mode, seconds')
+        self.parser.add_argument('--watch', action='store_true',
+                                 help='Reload changed map configs in daemon mode')
+        self.parser.add_argument('--timing', action='store', type=str,
+                                 help='Append time of render phases of every map to file as JSON lines, - for stdout')
+        self.parser.add_argument('--timing-table', action='store_true',
+                                 help='Print table with time of render phases of maps')
+        self.parser.add_argument('--metrics', action='store', type=str,
+                                 help='Write render metrics of maps to file for zabbix_sender -i')
+        self.parser.add_argument('--dry-run', action='store_true',
+                                 help='Load and check map configs without Zabbix requests, do not render')
+        self.parser.add_argument('--cost', action='store_true',
+                                 help='With --dry-run print estimated Zabbix API calls of every map')
 
         self.parser.add_argument('-c', '--cfg', action='store', type=str, help='Config path')
+        self.parser.add_argument('--cache-ttl', action='store', type=int, default=86400,
+                                 help='Zabbix ID cache lifetime in seconds, 0 disable cache')
+        self.parser.add_argument('-w', '--workers', action='store', type=positive_int, default=4,
+                                 help='Max number of Zabbix API requests in parallel')
         # self.parser.add_argument('-a', '--all', action='store_true', help='all')
 
         self.parser.add_argument('-s', '--scan', nargs='+', action='store', type=str, help='Map names in Zabbix')
+        self.parser.add_argument('--scan-all', action='store_true', help='Scan all maps in Zabbix')
         self.parser.add_argument('-f', '--file', action='store_true', help='Zabbix authentication from map config file')
         self.parser.add_argument('-z', '--zabbix', action='store', type=str, help='Zabbix server url')
         self.parser.add_argument('-l', '--login', action='store', type=str, help='Login')
         self.parser.add_argument('-p', '--pwd', action='store', help='Password')
 
-        self.args = self.parser.parse_args()
+        self.args = self.parser.parse_args(argv)
+        if self.args.daemon and self.args.jobs > 1:
+            self.parser.error('argument -j/--jobs: not allowed with --daemon, daemon renders maps in one process')
+        self.timings = []
+        self.metrics = OrderedDict()
+        self.metrics_maps = []
         self._cfg_logging()
+        self.registry = ZabbixRegistry(cache_ttl=self.args.cache_ttl, workers=self.args.workers)
 
         if not vars(self.args):
             self.parser.print_help()
@@ -49,36 +187,71 @@ class WeathermapCLI(object):
             print('Network weathermap 1.1.5')
             sys.exit()
 
-        if self.args.map:
-            self._map_img()
-        elif self.args.scan and self.args.zabbix and self.args.login and self.args.pwd:
-            self._map_scan()
-        elif self.args.scan and self.args.file:
-            self._map_scan_cfg()
-        else:
-            self.parser.print_help()
-            sys.exit()
+        try:
+            if self.args.map and self.args.dry_run:
+                self._map_dry_run()
+            elif self.args.map and self.args.daemon:
+                self._map_daemon()
+            elif self.args.map:
+                self._map_img()
+            elif self.args.scan_all and self.args.zabbix and self.args.login and self.args.pwd:
+                self._map_scan_all()
+            elif self.args.scan and self.args.zabbix and self.args.login and self.args.pwd:
+                self._map_scan()
+            elif self.args.scan and self.args.file:
+                self._map_scan_cfg()
+            else:
+                self.parser.print_help()
+                sys.exit()
+        finally:
+            self.registry.logout()
 
     def _map_scan(self):
         if self.args.cfg:
             self.cfg_path = self.args.cfg
-        for map_n in self.args.scan:
-            zbx = ZabbixAgent(self.args.zabbix, self.args.login, self.args.pwd)
-            map_data = zbx.scan_map(map_n)
-            scan_map = ConfigCreate(map_data, zbx)
+        zbx = self.registry.get(self.args.zabbix, self.args.login, self.args.pwd,
+                                cache_path=self.cfg_path + '/.zbxcache.json')
+        maps_data = self.registry.parallel([functools.partial(zbx.scan_map, map_n) for map_n in self.args.scan])
+        for map_data in maps_data:
+            scan_map = ConfigCreate(map_data, zbx, registry=self.registry)
             scan_map.create()
             scan_map.check_map(self.cfg_path)
             scan_map.save(self.cfg_path)
 
-            del zbx, scan_map, map_data
+            del scan_map, map_data
+
+    def _map_scan_all(self):
+        """ Create or update configs of all maps: maps and names of their elements are requested at once,
+        configs are created and merged with existing configs in parallel """
+        if self.args.cfg:
+            self.cfg_path = self.args.cfg
+        zbx = self.registry.get(self.args.zabbix, self.args.login, self.args.pwd,
+                                cache_path=self.cfg_path + '/.zbxcache.json')
+        scan_maps = ConfigCreate.create_all(zbx.scan_map_all(), zbx, registry=self.registry)
+        results = self.registry.parallel([functools.partial(self._scan_save, scan_map) for scan_map in scan_maps])
+        failed = [scan_map.map_data['name'] for scan_map, ok in zip(scan_maps, results) if not ok]
+        log.info('Maps scanned: %s', len(scan_maps) - len(failed))
+        if failed:
+            log.error('Failed maps: %s', ' '.join(failed))
+            sys.exit(1)
+
+    def _scan_save(self, scan_map):
+        try:
+            scan_map.create()
+            scan_map.check_map(self.cfg_path)
+            scan_map.save(self.cfg_path)
+        except Exception:
+            log.exception('Map %s: config not created', scan_map.map_data['name'])
+            return False
+        return True
 
     def _map_scan_cfg(self):
         if self.args.cfg:
             self.cfg_path = self.args.cfg
         for map_n in self.args.scan:
-            cfg = ConfigLoader(self.cfg_path + '/' + map_n + '.yaml')
+            cfg = ConfigLoader(self.cfg_path + '/' + map_n + '.yaml', registry=self.registry)
             map_data = cfg.zbx.scan_map(map_n)
-            scan_map = ConfigCreate(map_data, cfg.zbx)
+            scan_map = ConfigCreate(map_data, cfg.zbx, registry=self.registry)
             scan_map.create()
             scan_map.check_map(self.cfg_path)
             scan_map.save(self.cfg_path)
@@ -90,17 +263,243 @@ class WeathermapCLI(object):
             self.cfg_path = self.args.cfg
         if self.args.img:
             self.img_path = self.args.img
+        failed = []
+        cfgs = OrderedDict()
+        for map_fn in self.args.map:
+            cfg = self._load_cfg(map_fn)
+            if cfg is None:
+                failed.append(map_fn)
+            else:
+                cfgs[map_fn] = cfg
+
+        fetched = self.registry.parallel([functools.partial(self._fetch, map_fn, cfg) for map_fn, cfg in cfgs.items()])
+        for map_fn, ok in zip(list(cfgs), fetched):
+            if not ok:
+                failed.append(map_fn)
+                cfg = cfgs.pop(map_fn)
+                self._report(map_fn, cfg.phases, 'failed', cfg)
+
+        skipped = []
+        if self.args.jobs > 1:
+            with ProcessPoolExecutor(max_workers=self.args.jobs) as executor:
+                futures = OrderedDict((map_fn, executor.submit(render_map, cfg, self.font_path_fn, self.icon_path,
+                                                               self._img_path_fn(map_fn, cfg), self.args.upload,
+                                                               self.args.force, not self.args.no_save))
+                                      for map_fn, cfg in cfgs.items())
+                for map_fn, future in futures.items():
+                    try:
+                        if not self._publish(map_fn, cfgs[map_fn], future.result()):
+                            skipped.append(map_fn)
+                    except Exception:
+                        log.exception('Map %s failed', map_fn)
+                        failed.append(map_fn)
+                        self._report(map_fn, cfgs[map_fn].phases, 'failed', cfgs[map_fn])
+        else:
+            for map_fn, cfg in cfgs.items():
+                try:
+                    if not self._render(map_fn, cfg):
+                        skipped.append(map_fn)
+                except Exception:
+                    log.exception('Map %s failed', map_fn)
+                    failed.append(map_fn)
+                    self._report(map_fn, cfg.phases, 'failed', cfg)
+
+        for map_fn, cfg in cfgs.items():
+            if cfg.api_calls.methods:
+                log.info('Map %s: Zabbix API %s', map_fn, cfg.api_calls.report())
+        if self.args.timing_table and self.timings:
+            print(timing_table(self.timings, self.phases))
+        self._write_metrics()
+        if skipped:
+            log.info('Not changed maps: %s', ' '.join(skipped))
+        if failed:
+            log.error('Failed maps: %s', ' '.join(failed))
+            sys.exit(1)
+
+    def _map_dry_run(self):
+        """ Check configs, with --cost print Zabbix API calls that one run of every map will make """
+        if self.args.cfg:
+            self.cfg_path = self.args.cfg
+        if self.args.img:
+            self.img_path = self.args.img
+        failed = []
         for map_fn in self.args.map:
-            cfg = ConfigLoader(self.cfg_path + '/' + map_fn)
-            map_obj = cfg.create_map(self.font_path_fn, self.icon_path)
-            map_obj.do()
-            # map_obj.show()
-            map_obj.save_img(self.img_path + '/' + map_fn[:-5] + '.png')
+            try:
+                cfg = ConfigLoader(self.cfg_path + '/' + map_fn, registry=self.registry, login=False)
+            except Exception:
+                log.exception('Map %s: config not loaded', map_fn)
+                failed.append(map_fn)
+                continue
+            if not self.args.cost:
+                log.info('Map %s: config checked', map_fn)
+                continue
+            img_path_fn = self._img_path_fn(map_fn, cfg)
+            image_size = os.path.getsize(img_path_fn) if os.path.exists(img_path_fn) else 0
+            interval = int(cfg.cfg_dict['map'].get('interval') or self.args.interval)
+            print('Map {}: {} items, run every {} sec{}'.format(
+                map_fn, len(cfg.items()), interval,
+                (', upload of {} B image'.format(image_size) if image_size else ', upload of new image')
+                if self.args.upload else ''))
+            print(cost_table(cfg.cost(upload=self.args.upload, image_size=image_size), interval))
+        if failed:
+            log.error('Failed maps: %s', ' '.join(failed))
+            sys.exit(1)
+
+    @staticmethod
+    def _fetch(map_fn, cfg):
+        try:
+            cfg.fetch()
+        except Exception:
+            log.exception('Map %s: items not fetched', map_fn)
+            return False
+        return True
+
+    def _img_path_fn(self, map_fn, cfg):
+        return self.img_path + '/' + map_fn[:-5] + cfg.image_format().extension
+
+    def _render(self, map_fn, cfg):
+        """ :return: False if map is not changed """
+        result = render_map(cfg, self.font_path_fn, self.icon_path, self._img_path_fn(map_fn, cfg), self.args.upload,
+                            self.args.force, not self.args.no_save)
+        return self._publish(map_fn, cfg, result)
+
+    def _publish(self, map_fn, cfg, result):
+        """ Upload rendered map and save its fingerprint
+        :param result: tuple (fingerprint, encoded image, times of phases) from render_map
+        :return: False if map is not changed """
+        fingerprint, image, times = result
+        # times of phases measured in worker process with --jobs
+        cfg.phases.times = times
+        if fingerprint is None:
+            log.info('Map %s not changed, image not saved and not uploaded', map_fn)
+            self._report(map_fn, cfg.phases, 'not changed', cfg)
+            return False
+        if self.args.upload:
+            cfg.upload(image)
+        try:
+            write_fingerprint(self._img_path_fn(map_fn, cfg), fingerprint, self.args.upload, not self.args.no_save)
+        except OSError as exc:
+            # image is already uploaded, without fingerprint next run renders map again
+            log.warning('Map %s: fingerprint not saved %s', map_fn, exc)
+        self._report(map_fn, cfg.phases, 'rendered', cfg, len(image))
+        return True
+
+    def _phases(self):
+        return Phases(enabled=bool(self.args.timing or self.args.timing_table or self.args.metrics))
+
+    def _report(self, map_fn, phases, status, cfg=None, image_size=None):
+        """ Write times of map render phases as JSON line and keep them for timing table, keep map metrics,
+        phases are reset
+        :param status: rendered, not changed or failed
+        :param cfg: ConfigLoader of map, None if config is not loaded
+        :param image_size: size of encoded image, None if map is not rendered """
+        if not phases.enabled:
+            return
+        if self.args.metrics:
+            self.metrics[map_fn] = self._map_metrics(map_fn, phases, status, cfg, image_size)
+        row = OrderedDict([('time', round(time.time(), 3)), ('map', map_fn), ('status', status)])
+        row.update((phase, round(value, 4)) for phase, value in phases.times.items())
+        row['total'] = round(sum(phases.times.values()), 4)
+        phases.reset()
+        if self.args.timing_table and not self.args.daemon:
+            self.timings.append(row)
+        if self.args.timing == '-':
+            print(json.dumps(row))
+            sys.stdout.flush()
+        elif self.args.timing:
+            with open(self.args.timing, 'a') as timing_file:
+                timing_file.write(json.dumps(row) + '\n')
+
+    def _map_metrics(self, map_fn, phases, status, cfg, image_size):
+        """ :return: OrderedDict {item key: value} of map render metrics """
+        name = map_fn[:-5] if map_fn.endswith('.yaml') else map_fn
+        metrics = OrderedDict()
+        metrics[sender_key('weathermap.failed', name)] = int(status == 'failed')
+        metrics[sender_key('weathermap.skipped', name)] = int(status == 'not changed')
+        metrics[sender_key('weathermap.render.time', name)] = round(sum(phases.times.values()), 4)
+        metrics[sender_key('weathermap.fetch.time', name)] = round(phases.times.get('fetch', 0.0), 4)
+        if cfg is not None:
+            metrics[sender_key('weathermap.links', name)] = len([link for link in cfg.cfg_dict if 'link-' in link])
+            metrics[sender_key('weathermap.links.failed', name)] = cfg.failed_links()
+            metrics[sender_key('weathermap.interval', name)] = int(cfg.cfg_dict['map'].get('interval') or
+                                                                         self.args.interval)
+        if image_size is not None:
+            metrics[sender_key('weathermap.image.bytes', name)] = image_size
+        return metrics
+
+    def _write_metrics(self):
+        """ Write discovery of all reported maps and metrics of maps reported since the last write to --metrics file
+        for zabbix_sender -i. Map which is not rendered any more is not sent again, nodata trigger fires """
+        if not self.args.metrics or not self.metrics:
+            return
+        self.metrics_maps.extend(map_fn for map_fn in self.metrics if map_fn not in self.metrics_maps)
+        maps = [{'{#MAP}': map_fn[:-5] if map_fn.endswith('.yaml') else map_fn} for map_fn in self.metrics_maps]
+        lines = [sender_line('weathermap.discovery', json.dumps({'data': maps}, separators=(',', ':')))]
+        for metrics in self.metrics.values():
+            lines.extend(sender_line(key, value) for key, value in metrics.items())
+        write_atomic(self.args.metrics, '\n'.join(lines) + '\n')
+        self.metrics.clear()
+
+    def _map_daemon(self):
+        """ Load configs once and render every map on its interval: option interval in section [map]
+        or --interval. Zabbix sessions, nodes and links are kept between renders, with --watch changed config
+        is reloaded before render and only its changed nodes and links are rebuilt. Config not loaded is loaded
+        again on next --interval. SIGTERM stops daemon like Ctrl-C """
+        if self.args.cfg:
+            self.cfg_path = self.args.cfg
+        if self.args.img:
+            self.img_path = self.args.img
+        cfgs = OrderedDict((map_fn, None) for map_fn in self.args.map)
+        schedule = [(time.monotonic(), map_fn) for map_fn in cfgs]
+        heapq.heapify(schedule)
+        log.info('Daemon started, maps: %s', len(cfgs))
+
+        sigterm = None
+        if threading.current_thread() is threading.main_thread():
+            sigterm = signal.signal(signal.SIGTERM, self._sigterm)
+        try:
+            while schedule:
+                start, map_fn = heapq.heappop(schedule)
+                time.sleep(max(0.0, start - time.monotonic()))
+                cycle_start = time.monotonic()
+                cfg = cfgs[map_fn]
+                if cfg is None:
+                    cfg = cfgs[map_fn] = self._load_cfg(map_fn)
+                elif self.args.watch:
+                    try:
+                        cfg.reload()
+                    except Exception:
+                        log.exception('Map %s: config not reloaded, previous config is used', map_fn)
+                if cfg is not None:
+                    try:
+                        cfg.fetch()
+                        if self._render(map_fn, cfg):
+                            log.info('Map %s rendered in %.3f sec', map_fn, time.monotonic() - cycle_start)
+                    except Exception:
+                        log.exception('Map %s failed after %.3f sec', map_fn, time.monotonic() - cycle_start)
+                        self._report(map_fn, cfg.phases, 'failed', cfg)
+                self._write_metrics()
+                interval = int(cfg and cfg.cfg_dict['map'].get('interval') or self.args.interval)
+                heapq.heappush(schedule, (max(start + interval, time.monotonic()), map_fn))
+        except KeyboardInterrupt:
+            log.info('Daemon stopped')
+        finally:
+            if sigterm is not None:
+                signal.signal(signal.SIGTERM, sigterm)
 
-            if self.args.upload:
-                cfg.upload(self.img_path + '/' + map_fn[:-5] + '.png')
+    @staticmethod
+    def _sigterm(signum, frame):
+        raise KeyboardInterrupt
 
-            del cfg, map_obj
+    def _load_cfg(self, map_fn):
+        """ :return: ConfigLoader of map, None if config is not loaded, failure is logged and reported """
+        phases = self._phases()
+        try:
+            return ConfigLoader(self.cfg_path + '/' + map_fn, registry=self.registry, phases=phases)
+        except Exception:
+            log.exception('Map %s: config not loaded', map_fn)
+            self._report(map_fn, phases, 'failed')
+            return None
 
     def _cfg_logging(self):
         """
@@ -3,8 +3,19 @@
 # __author__ = 'maximus'
 
 import logging
-from pyzabbix import ZabbixAPI
-import base64
+from pyzabbix import ZabbixAPI, ZabbixAPIException
+from pyzabbix.api import urlopen
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import functools
+import hashlib
+import json
+import threading
+import time
+from urllib.request import Request
+
+from fileio import write_atomic
 
 log = logging.getLogger(__name__)
 
@@ -14,70 +25,412 @@ class ZbxException(Exception):
         self.message = message
 
 
+class ApiCalls(object):
+    """ Zabbix API calls by method: number of calls, seconds, request and response bytes """
+
+    def __init__(self):
+        self.methods = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'methods': self.methods}
+
+    def __setstate__(self, state):
+        self.methods = state['methods']
+        self.lock = threading.Lock()
+
+    def add(self, method, seconds=0.0, sent=0, received=0, calls=1):
+        with self.lock:
+            stat = self.methods.setdefault(method, [0, 0.0, 0, 0])
+            stat[0] += calls
+            stat[1] += seconds
+            stat[2] += sent
+            stat[3] += received
+
+    def total(self):
+        """ :return: list [calls, seconds, sent bytes, received bytes] of all methods """
+        return [sum(stat[i] for stat in self.methods.values()) for i in range(4)]
+
+    def report(self):
+        """ :return: str, like: 3 calls, 0.051 sec, 1020 B sent, 5311 B received: host.get 1, item.get 2 """
+        calls, seconds, sent, received = self.total()
+        methods = ', '.join('{} {}'.format(method, stat[0]) for method, stat in self.methods.items())
+        return '{} calls, {:.3f} sec, {} B sent, {} B received: {}'.format(calls, seconds, sent, received, methods)
+
+
+_accounting = threading.local()
+
+
+@contextmanager
+def accounting(api_calls: ApiCalls):
+    """ Count Zabbix API calls made in this thread and in its parallel calls to api_calls """
+    previous = getattr(_accounting, 'calls', None)
+    _accounting.calls = api_calls
+    try:
+        yield api_calls
+    finally:
+        _accounting.calls = previous
+
+
+def _accounted(api_calls, call):
+    with accounting(api_calls):
+        return call()
+
+
+def parallel(calls, workers=1):
+    """ Run independent calls in a thread pool, API calls accounting of caller thread is kept in pool threads
+    :param calls: list of callables without arguments
+    :param workers: max number of threads
+    :return: list of results in order of calls"""
+    if workers <= 1 or len(calls) <= 1:
+        return [call() for call in calls]
+    api_calls = getattr(_accounting, 'calls', None)
+    if api_calls is not None:
+        calls = [functools.partial(_accounted, api_calls, call) for call in calls]
+    with ThreadPoolExecutor(max_workers=min(workers, len(calls))) as executor:
+        futures = [executor.submit(call) for call in calls]
+        return [future.result() for future in futures]
+
+
+class ZabbixRPC(ZabbixAPI):
+    """ ZabbixAPI with limit of JSON-RPC requests in flight, limit is shared semaphore.
+    Calls are counted to ApiCalls of accounting context with sizes of HTTP request and response bodies.
+    Expired session is logged in again and request is repeated once """
+    # requests not repeated after login
+    no_relogin = ('apiinfo.version', 'user.login', 'user.logout')
+
+    def __init__(self, url, login, password, limit=None):
+        self.limit = limit
+        self.credentials = (login, password)
+        self.login_lock = threading.Lock()
+        super().__init__(url=url, use_authenticate=False, user=login, password=password)
+
+    def do_request(self, method, params=None):
+        auth = self.auth
+        try:
+            return self._request(method, params)
+        except ZabbixAPIException as exc:
+            if auth is None or method in self.no_relogin or not session_expired(exc):
+                raise
+        with self.login_lock:
+            if self.auth == auth:
+                log.warning('Zabbix %s: session expired, login again', self.url)
+                login, password = self.credentials
+                self.auth = self.user.login(user=login, password=password)
+        return self._request(method, params)
+
+    def _request(self, method, params=None):
+        start = time.perf_counter()
+        sizes = [0, 0]
+        try:
+            return self._post(method, params, sizes)
+        finally:
+            api_calls = getattr(_accounting, 'calls', None)
+            if api_calls is not None:
+                api_calls.add(method, time.perf_counter() - start, *sizes)
+
+    def _post(self, method, params, sizes):
+        """ JSON-RPC request like ZabbixAPI.do_request, reply is not dumped again for debug log
+        :param sizes: list, set to sizes of HTTP request and response bodies
+        :return: reply dict """
+        request_json = {'jsonrpc': '2.0', 'method': method, 'params': params or {}, 'id': '1'}
+        if self.auth and method not in ('apiinfo.version', 'user.login'):
+            request_json['auth'] = self.auth
+        data = json.dumps(request_json).encode('utf-8')
+        sizes[0] = len(data)
+        request = Request(self.url, data, method='POST', headers={'Content-Type': 'application/json-rpc',
+                                                                  'User-Agent': 'py-zabbix'})
+        if self.limit is None:
+            body = self._read(request)
+        else:
+            with self.limit:
+                body = self._read(request)
+        sizes[1] = len(body)
+        try:
+            reply = json.loads(body.decode('utf-8'))
+        except ValueError as exc:
+            raise ZabbixAPIException('Unable to parse json: %s' % exc)
+        if 'error' in reply:
+            error = reply['error'].copy()
+            error['json'] = str(request_json)
+            raise ZabbixAPIException(error)
+        return reply
+
+    @staticmethod
+    def _read(request):
+        with urlopen(request) as response:
+            return response.read()
+
+
+def session_expired(exc: ZabbixAPIException):
+    """ :return: True if Zabbix API error is expired, terminated or unknown session """
+    message = '{} {}'.format(getattr(exc, 'message', ''), getattr(exc, 'data', ''))
+    return any(text in message for text in ('Session terminated', 'Not authorised', 'Not authorized'))
+
+
+def request_size(method, params, auth=None):
+    """ Size of JSON-RPC request in bytes """
+    request = {'jsonrpc': '2.0', 'method': method, 'params': params or {}, 'id': '1'}
+    if auth and method not in ('apiinfo.version', 'user.login'):
+        request['auth'] = auth
+    return len(json.dumps(request).encode('utf-8'))
+
+
+def response_size(result):
+    """ Size of JSON-RPC response with result in bytes """
+    return len(json.dumps({'jsonrpc': '2.0', 'result': result, 'id': '1'}))
+
+
+class ZabbixCache(object):
+    """ Persistent cache of Zabbix object IDs, stored in json file and keyed by Zabbix url.
+    Entries older than ttl seconds are ignored. ttl = 0 disable cache """
+
+    def __init__(self, path, url, ttl=86400):
+        self.path = path
+        self.url = url
+        self.ttl = ttl
+        self.entries = {}
+        self.changed = False
+        self.lock = threading.Lock()
+        if self.ttl:
+            self.entries = self._read().get(self.url, {})
+        log.debug('Object ZabbixCache created')
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, section, key):
+        entry = self.entries.get(section, {}).get(key)
+        if entry is None or time.time() - entry[1] > self.ttl:
+            return None
+        return entry[0]
+
+    def set(self, section, key, value):
+        if self.ttl:
+            with self.lock:
+                self.entries.setdefault(section, {})[key] = [value, int(time.time())]
+                self.changed = True
+
+    def delete(self, section, key):
+        with self.lock:
+            if self.entries.get(section, {}).pop(key, None) is not None:
+                self.changed = True
+
+    def save(self):
+        """ Write cache file, entries older than ttl are dropped. Cache is best-effort, failed write is logged """
+        with self.lock:
+            if not self.changed:
+                return
+            data = self._read()
+            data[self.url] = self.entries
+            data = {url: self._fresh(entries) for url, entries in data.items()}
+            self.entries = data[self.url]
+            try:
+                write_atomic(self.path, json.dumps(data))
+            except OSError as exc:
+                log.warning('Zabbix cache not saved %s: %s', self.path, exc)
+                return
+            self.changed = False
+        log.debug('Zabbix cache saved %s', self.path)
+
+    def _fresh(self, entries):
+        """ :return: entries {section: {key: [value, timestamp]}} not older than ttl """
+        now = time.time()
+        return {section: {key: entry for key, entry in keys.items() if now - entry[1] <= self.ttl}
+                for section, keys in entries.items()}
+
+
 class ZabbixAgent(object):
+    chunk_size = 1000
+    # auth token and values in API cost estimate
+    auth_sample = '0' * 32
+    id_sample = '1000000'
+    value_sample = '1234567890'
 
-    def __init__(self, url, login, password):
+    def __init__(self, url, login, password, cache=None, workers=1, limit=None):
         self.url = url
         self.login = login
         self.password = password
-        self.zbx_api = ZabbixAPI(url=url, use_authenticate=False, user=login, password=password)
+        self.cache = cache
+        self.workers = workers
+        self.zbx_api = ZabbixRPC(url, login, password, limit=limit)
         log.debug('Object ZabbixAgent created')
-        log.debug('API ver. %s', self.api_ver())
-
-    def get_item_data(self, hostname, item):
-        reply = self.zbx_api.host.get(filter={'name': hostname}, output='shorten')
-        if not reply:
-            raise ZbxException("hostname: {} not found".format(hostname))
-        hostid = reply[0]['hostid']
-        log.debug('hostID %s', hostid)
-
-        item_data = self.zbx_api.item.get(filter={'hostid': hostid, 'key_': item}, output=['lastvalue'])
-        log.debug('itemID %s', hostid)
-        if not item_data:
-            raise ZbxException('item: {} not found'.format(item))
-
-        if len(item_data) > 1:
-            raise ZbxException('return items expected one item')
-        return int(item_data[0]['lastvalue'])
-
-    def get_item_data2(self, hostname, item_in, item_out):
-        reply = self.zbx_api.host.get(filter={'name': hostname}, output='shorten')
-        if not reply:
-            raise ZbxException("hostname: {} not found".format(hostname))
-        hostid = reply[0]['hostid']
-        log.debug('hostID %s', hostid)
-
-        if '+' in item_in:
-            item_in_split = list(map(str.strip, item_in.split('+')))
-            item_in_data = self.zbx_api.item.get(filter={'hostid': hostid, 'key_': item_in_split[0]}, output=['lastvalue'])
-            for item_in_elem in item_in_split[1:]:
-                item_in_data[0]['lastvalue'] = str(int(item_in_data[0]['lastvalue']) + int(self.zbx_api.item.get(filter={'hostid': hostid, 'key_': item_in_elem}, output=['lastvalue'])[0]['lastvalue']))
-        else:
-            item_in_data = self.zbx_api.item.get(filter={'hostid': hostid, 'key_': item_in}, output=['lastvalue'])
-
-        log.debug('itemID %s', hostid)
-        if not item_in_data:
-            raise ZbxException('item: {} not found'.format(item_in))
-
-        if '+' in item_out:
-            item_out_split = list(map(str.strip, item_out.split('+')))
-            item_out_data = self.zbx_api.item.get(filter={'hostid': hostid, 'key_': item_out_split[0]}, output=['lastvalue'])
-            for item_out_elem in item_out_split[1:]:
-                item_out_data[0]['lastvalue'] = str(int(item_out_data[0]['lastvalue']) + int(self.zbx_api.item.get(filter={'hostid': hostid, 'key_': item_out_elem}, output=['lastvalue'])[0]['lastvalue']))
-        else:
-            item_out_data = self.zbx_api.item.get(filter={'hostid': hostid, 'key_': item_out}, output=['lastvalue'])
-
-        log.debug('itemID %s', hostid)
-        if not item_in_data:
-            raise ZbxException('item: {} not found'.format(item_out))
-
-        if len(item_in_data) > 1:
-            raise ZbxException('return items expected one item: {}'.format(item_in_data))
-
-        if len(item_out_data) > 1:
-            raise ZbxException('return items expected one item: {}'.format(item_out_data))
-
-        return int(item_in_data[0]['lastvalue']), int(item_out_data[0]['lastvalue'])
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('API ver. %s', self.api_ver())
+
+    def logout(self):
+        if self.cache:
+            self.cache.save()
+        if self.zbx_api.auth:
+            self.zbx_api.user.logout()
+            self.zbx_api.auth = None
+        log.debug('Logout %s', self.url)
+
+    def get_items_data(self, items):
+        """Bulk request of item last values. Items with cached itemid are requested by item.get(itemids) in chunks,
+        the rest are resolved by one host.get and one item.get, the requests run in parallel
+        :param items: iterable of (hostname, item key) pairs, item key may be a sum: key1 + key2
+        :return: dict {(hostname, item key): value}"""
+        items = set(items)
+        if not items:
+            return {}
+
+        keys, chunks, uncached = self.plan_items(items, self.cache, self.chunk_size)
+        values = {}
+        calls = [functools.partial(self._items_by_ids, chunk) for chunk in chunks]
+        if uncached:
+            calls.append(functools.partial(self._resolve_items, uncached))
+        for reply in self.parallel(calls):
+            values.update(reply)
+
+        invalidated = keys - set(values.keys())
+        if invalidated:
+            values.update(self._resolve_items(invalidated))
+
+        if self.cache:
+            self.cache.save()
+
+        result = {}
+        for hostname, item in items:
+            result[(hostname, item)] = 0
+            for key in self.split_item(item):
+                result[(hostname, item)] += int(values[(hostname, key)])
+        return result
+
+    @classmethod
+    def plan_items(cls, items, cache=None, chunk_size=None):
+        """ Split item keys to chunks of cached itemids and keys to resolve by hostname and key
+        :param items: set of (hostname, item key) pairs
+        :return: tuple (set of (hostname, key), list of dict {itemid: (hostname, key)}, set of (hostname, key)) """
+        keys = {(hostname, key) for hostname, item in items for key in cls.split_item(item)}
+        itemids = {}
+        if cache:
+            for hostname, key in keys:
+                itemid = cache.get('items', hostname + '\n' + key)
+                if itemid:
+                    itemids[itemid] = (hostname, key)
+        itemids_list = list(itemids.items())
+        chunk_size = chunk_size or cls.chunk_size
+        chunks = [dict(itemids_list[i:i + chunk_size]) for i in range(0, len(itemids_list), chunk_size)]
+        return keys, chunks, keys - set(itemids.values())
+
+    @classmethod
+    def estimate_items(cls, items, cache=None, api_calls=None):
+        """ Predict API calls of get_items_data without requests, size of replies is estimated
+        :param items: set of (hostname, item key) pairs
+        :return: ApiCalls """
+        api_calls = api_calls or ApiCalls()
+        if not items:
+            return api_calls
+        keys, chunks, uncached = cls.plan_items(set(items), cache)
+        for chunk in chunks:
+            params = {'itemids': list(chunk), 'output': ['itemid', 'key_', 'lastvalue']}
+            result = [{'itemid': itemid, 'key_': key, 'lastvalue': cls.value_sample}
+                      for itemid, (_, key) in chunk.items()]
+            api_calls.add('item.get', sent=request_size('item.get', params, cls.auth_sample),
+                          received=response_size(result))
+        if uncached:
+            hostnames = sorted({hostname for hostname, _ in uncached})
+            params = {'filter': {'name': hostnames}, 'output': ['hostid', 'name']}
+            result = [{'hostid': cls.id_sample, 'name': hostname} for hostname in hostnames]
+            api_calls.add('host.get', sent=request_size('host.get', params, cls.auth_sample),
+                          received=response_size(result))
+            params = {'hostids': [cls.id_sample] * len(hostnames), 'filter': {'key_': sorted({k for _, k in uncached})},
+                      'output': ['itemid', 'hostid', 'key_', 'lastvalue']}
+            result = [{'itemid': cls.id_sample, 'hostid': cls.id_sample, 'key_': key, 'lastvalue': cls.value_sample}
+                      for _, key in uncached]
+            api_calls.add('item.get', sent=request_size('item.get', params, cls.auth_sample),
+                          received=response_size(result))
+        return api_calls
+
+    @classmethod
+    def estimate_upload(cls, zbx_img_name, b64_size, cache=None, api_calls=None):
+        """ Predict API calls of upload_image of changed image without requests
+        :param b64_size: size of base64 image
+        :return: ApiCalls """
+        api_calls = api_calls or ApiCalls()
+        cached = cache.get('images', zbx_img_name) if cache else None
+        if cached:
+            params = {'imageid': cached[0], 'image': ''}
+            api_calls.add('image.update', sent=request_size('image.update', params, cls.auth_sample) + b64_size,
+                          received=response_size({'imageids': [cached[0]]}))
+            return api_calls
+        params = {'filter': {'name': zbx_img_name}, 'output': ['imageid']}
+        api_calls.add('image.get', sent=request_size('image.get', params, cls.auth_sample),
+                      received=response_size([{'imageid': cls.id_sample}]))
+        params = {'name': zbx_img_name, 'imagetype': 2, 'image': ''}
+        api_calls.add('image.create', sent=request_size('image.create', params, cls.auth_sample) + b64_size,
+                      received=response_size({'imageids': [cls.id_sample]}))
+        return api_calls
+
+    @classmethod
+    def estimate_login(cls, login, password, api_calls=None):
+        """ Predict API calls of login and logout
+        :return: ApiCalls """
+        api_calls = api_calls or ApiCalls()
+        api_calls.add('user.login', sent=request_size('user.login', {'user': login, 'password': password}),
+                      received=response_size(cls.auth_sample))
+        api_calls.add('user.logout', sent=request_size('user.logout', [], cls.auth_sample),
+                      received=response_size(True))
+        return api_calls
+
+    def _resolve_items(self, keys):
+        """ Resolve hostname and item key to item with one host.get and one item.get
+        :param keys: set of (hostname, item key) pairs
+        :return: dict {(hostname, item key): lastvalue}"""
+        hostnames = sorted({hostname for hostname, _ in keys})
+        reply = self.zbx_api.host.get(filter={'name': hostnames}, output=['hostid', 'name'])
+        hostids = {host['name']: host['hostid'] for host in reply}
+        for hostname in hostnames:
+            if hostname not in hostids:
+                raise ZbxException("hostname: {} not found".format(hostname))
+        log.debug('hostIDs %s', hostids)
+
+        item_data = self.zbx_api.item.get(hostids=list(hostids.values()), filter={'key_': sorted({k for _, k in keys})},
+                                          output=['itemid', 'hostid', 'key_', 'lastvalue'])
+        items = {}
+        for item in item_data:
+            if (item['hostid'], item['key_']) in items:
+                raise ZbxException('return items expected one item: {}'.format(item))
+            items[(item['hostid'], item['key_'])] = item
+
+        values = {}
+        for hostname, key in keys:
+            try:
+                item = items[(hostids[hostname], key)]
+            except KeyError:
+                raise ZbxException('item: {} not found'.format(key))
+            values[(hostname, key)] = item['lastvalue']
+            if self.cache:
+                self.cache.set('items', hostname + '\n' + key, item['itemid'])
+        return values
+
+    def _items_by_ids(self, itemids):
+        """ Request last values by cached itemids, missing items removed from cache
+        :param itemids: dict {itemid: (hostname, item key)}
+        :return: dict {(hostname, item key): lastvalue}"""
+        values = {}
+        item_data = self.zbx_api.item.get(itemids=list(itemids.keys()), output=['itemid', 'key_', 'lastvalue'])
+        for item in item_data:
+            if itemids[item['itemid']][1] == item['key_']:
+                values[itemids[item['itemid']]] = item['lastvalue']
+        for itemid, (hostname, key) in itemids.items():
+            if (hostname, key) not in values:
+                log.debug('itemID %s missing, cache invalidated', itemid)
+                self.cache.delete('items', hostname + '\n' + key)
+        return values
+
+    def parallel(self, calls):
+        return parallel(calls, self.workers)
+
+    @staticmethod
+    def split_item(item):
+        """ Split item key with summands: key1 + key2 """
+        return list(map(str.strip, item.split('+')))
 
     def api_ver(self):
         return self.zbx_api.api_version()
@@ -96,80 +449,111 @@ class ZabbixAgent(object):
         return map_data[0]
 
     def scan_map_all(self):
-        maps_data = self.zbx_api.map.get(selectSelements=['elementid', 'selementid', 'elementtype', 'iconid_off',
+        """ All maps with elements and links by one request """
+        maps_data = self.zbx_api.map.get(selectSelements=['elements', 'selementid', 'elementtype', 'iconid_off',
                                                           'x', 'y'],
                                          selectLinks=['selementid1', 'selementid2', 'linkid'])
         if not maps_data:
             raise ZbxException('maps not found')
-
-        if len(maps_data) > 1:
-            raise ZbxException('return maps expected one map')
         return maps_data
 
-    def get_hostname(self, hostid):
-        hostname = self.zbx_api.host.get(hostids=hostid, output=['host'])
-
-        if not hostname:
-            raise ZbxException('hostname not found')
-
-        if len(hostname) > 1:
-            raise ZbxException('return hostnames expected one hostname')
-
-        return hostname[0]['host']
-
-    def get_mapname(self, mapid):
-        mapname = self.zbx_api.map.get(sysmapids=mapid, output=['name'])
-
-        if not mapname:
-            raise ZbxException('map name not found')
-
-        if len(mapname) > 1:
-            raise ZbxException('return map names expected one map name')
-
-        return mapname[0]['name']
-
-    def get_triggername(self, triggerid):
-        triggername = self.zbx_api.trigger.get(triggerid=triggerid, output=['description'])
-
-        if not triggername:
-            raise ZbxException('trigger name not found')
-
-        if len(triggername) > 1:
-            raise ZbxException('return trigger names expected one trigger name')
-
-        return triggername[0]['description']
-
-    def get_hostgroupname(self, groupid):
-        hostgroupname = self.zbx_api.hostgroup.get(groupids=groupid, output=['name'])
-
-        if not hostgroupname:
-            raise ZbxException('hostgroup name not found')
-
-        if len(hostgroupname) > 1:
-            raise ZbxException('return hostgroup names expected one hostgroup name')
-
-        return hostgroupname[0]['name']
-
-    def get_imagename(self, imageid):
-        imagename = self.zbx_api.image.get(imageids=imageid, output=['name'])
-
-        if not imagename:
-            raise ZbxException('image name not found')
-
-        if len(imagename) > 1:
-            raise ZbxException('return image names expected one image name')
-
-        return imagename[0]['name']
-
-    def image_to_zabbix(self, pathfn, zbx_img_name):
-        with open(pathfn, 'rb') as img:
-            b64img = base64.b64encode(img.read()).decode()
-        image_data = self.zbx_api.image.get(filter={'name': zbx_img_name})
+    def get_hostnames(self, hostids):
+        reply = self.zbx_api.host.get(hostids=list(hostids), output=['hostid', 'host'])
+        return self._names(hostids, reply, 'hostid', 'host', 'hostname')
+
+    def get_mapnames(self, mapids):
+        reply = self.zbx_api.map.get(sysmapids=list(mapids), output=['sysmapid', 'name'])
+        return self._names(mapids, reply, 'sysmapid', 'name', 'map name')
+
+    def get_triggernames(self, triggerids):
+        reply = self.zbx_api.trigger.get(triggerids=list(triggerids), output=['triggerid', 'description'])
+        return self._names(triggerids, reply, 'triggerid', 'description', 'trigger name')
+
+    def get_hostgroupnames(self, groupids):
+        reply = self.zbx_api.hostgroup.get(groupids=list(groupids), output=['groupid', 'name'])
+        return self._names(groupids, reply, 'groupid', 'name', 'hostgroup name')
+
+    def get_imagenames(self, imageids):
+        reply = self.zbx_api.image.get(imageids=list(imageids), output=['imageid', 'name'])
+        return self._names(imageids, reply, 'imageid', 'name', 'image name')
+
+    @staticmethod
+    def _names(ids, reply, id_field, name_field, obj_name):
+        """ Map ids to names from bulk reply
+        :return: dict {id: name}"""
+        names = {obj[id_field]: obj[name_field] for obj in reply}
+        for objid in ids:
+            if objid not in names:
+                raise ZbxException('{} not found, id: {}'.format(obj_name, objid))
+        return names
+
+    def get_images(self, imageids):
+        """ Bulk request of images
+        :return: dict {imageid: base64 image}"""
+        image_data = self.zbx_api.image.get(imageids=list(imageids), output=['imageid'], select_image=True)
+        return {image['imageid']: image['image'] for image in image_data}
+
+    def upload_image(self, zbx_img_name, b64img):
+        """ Create or update background image. Imageid and checksum of last uploaded image are cached,
+        image equal to last uploaded is not sent, image is created if cached imageid not exist
+        :return: imageid """
+        checksum = hashlib.sha1(b64img.encode()).hexdigest()
+        cached = self.cache.get('images', zbx_img_name) if self.cache else None
+        if cached:
+            imageid, cached_checksum = cached
+            if cached_checksum == checksum:
+                log.debug('Image %s not changed, imageid: %s', zbx_img_name, imageid)
+                return imageid
+            try:
+                self.zbx_api.image.update(imageid=imageid, image=b64img)
+            except ZabbixAPIException:
+                log.debug('Image %s not found, imageid: %s', zbx_img_name, imageid)
+                self.cache.delete('images', zbx_img_name)
+            else:
+                self.cache.set('images', zbx_img_name, [imageid, checksum])
+                return imageid
+
+        image_data = self.zbx_api.image.get(filter={'name': zbx_img_name}, output=['imageid'])
         if not image_data:
-            self.zbx_api.image.create(name=zbx_img_name, imagetype=2, image=b64img)
+            imageid = self.zbx_api.image.create(name=zbx_img_name, imagetype=2, image=b64img)['imageids'][0]
         else:
-            self.zbx_api.image.update(imageid=image_data[0]['imageid'], image=b64img)
-
-    def image_get(self, imageid):
-        image_data = self.zbx_api.image.get(imageids=imageid, select_image=True)
-        return image_data[0]['image']
+            imageid = image_data[0]['imageid']
+            self.zbx_api.image.update(imageid=imageid, image=b64img)
+        if self.cache:
+            self.cache.set('images', zbx_img_name, [imageid, checksum])
+        return imageid
+
+
+class ZabbixRegistry(object):
+    """ One shared authenticated ZabbixAgent for every Zabbix url and login.
+    workers - max number of JSON-RPC requests in flight for all agents """
+
+    def __init__(self, cache_ttl=86400, workers=4):
+        if workers < 1:
+            raise ValueError('workers must be 1 or more, got %s' % workers)
+        self.cache_ttl = cache_ttl
+        self.workers = workers
+        self.limit = threading.BoundedSemaphore(workers)
+        self.agents = {}
+        self.lock = threading.Lock()
+        log.debug('Object ZabbixRegistry created')
+
+    def get(self, url, login, password, cache_path=None):
+        with self.lock:
+            if (url, login) not in self.agents:
+                cache = ZabbixCache(cache_path, url, ttl=self.cache_ttl) if cache_path else None
+                self.agents[(url, login)] = ZabbixAgent(url, login, password, cache=cache, workers=self.workers,
+                                                        limit=self.limit)
+            return self.agents[(url, login)]
+
+    def parallel(self, calls):
+        return parallel(calls, self.workers)
+
+    def logout(self):
+        with self.lock:
+            for (url, login), agent in self.agents.items():
+                try:
+                    agent.logout()
+                except Exception as exc:
+                    log.warning('Logout %s %s failed: %s', url, login, exc)
+            self.agents.clear()
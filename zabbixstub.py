@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# __author__ = 'maximus'
+
+""" Offline Zabbix JSON-RPC stand-in with generated hosts, items, map and images.
+Used by benchmark.py and tests, can be run standalone:
+
+    zabbixstub.py --links 1000 --latency 0.02 --port 8080
+"""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+log = logging.getLogger(__name__)
+
+
+class StubData(object):
+    """ Synthetic Zabbix objects: one map with links, host on every node, in/out items for every link """
+
+    def __init__(self, links=10, name='bench', seed=0):
+        self.name = name
+        self.rnd = random.Random(seed)
+        self.nodes = max(2, links // 3 + 2)
+        self.cols = int(self.nodes ** 0.5) + 1
+        self.step = 80
+        self.width = self.cols * self.step + 200
+        self.height = (self.nodes // self.cols + 1) * self.step + 200
+        self.hosts = {}
+        self.items = {}
+        self.links = []
+        self.images = {}
+        self.groups = {'1': 'Network'}
+        self.triggers = {}
+        self.maps = {}
+
+        icon_path = str(os.path.dirname(os.path.abspath(__file__))) + '/icons/Router64.png'
+        with open(icon_path, 'rb') as icon:
+            self.images['1'] = {'imageid': '1', 'name': 'Router64', 'imagetype': '1',
+                                'image': base64.b64encode(icon.read()).decode()}
+
+        for node in range(self.nodes):
+            hostid = str(10001 + node)
+            self.hosts[hostid] = {'hostid': hostid, 'host': 'host-{}'.format(node), 'name': 'host-{}'.format(node)}
+
+        for link in range(links):
+            node1 = link % self.nodes
+            node2 = (node1 + 1 + link // self.nodes) % self.nodes
+            if node2 == node1:
+                node2 = (node1 + 1) % self.nodes
+            hostid = str(10001 + node1)
+            keys = ('ifHCInOctets[{}]'.format(link), 'ifHCOutOctets[{}]'.format(link))
+            for key in keys:
+                itemid = str(100001 + len(self.items))
+                self.items[itemid] = {'itemid': itemid, 'hostid': hostid, 'key_': key,
+                                      'lastvalue': str(self.rnd.randint(0, 10 ** 9))}
+            self.links.append({'linkid': str(link + 1), 'node1': node1, 'node2': node2,
+                               'hostname': 'host-{}'.format(node1), 'itemin': keys[0], 'itemout': keys[1]})
+
+        selements = [{'selementid': str(node + 1), 'elementtype': '0',
+                      'elements': [{'hostid': str(10001 + node)}], 'iconid_off': '1',
+                      'x': str(self.node_xy(node)[0] - 32), 'y': str(self.node_xy(node)[1] - 32)}
+                     for node in range(self.nodes)]
+        sysmap_links = [{'linkid': link['linkid'], 'selementid1': str(link['node2'] + 1),
+                         'selementid2': str(link['node1'] + 1)} for link in self.links]
+        self.maps['1'] = {'sysmapid': '1', 'name': self.name, 'width': str(self.width),
+                          'height': str(self.height), 'selements': selements, 'links': sysmap_links}
+
+    def node_xy(self, node):
+        return 100 + (node % self.cols) * self.step, 100 + (node // self.cols) * self.step
+
+    def config(self, url, login='admin', password='zabbix'):
+        """ Map config with hostname and items set for every link, like after scan and manual edit """
+        cfg = {'map': {'name': self.name, 'bgcolor': '', 'fontsize': 10, 'width': self.width, 'height': self.height},
+               'zabbix': {'url': url, 'login': login, 'password': password},
+               'table': {'show': True, 'x': self.width - 100, 'y': 100},
+               'palette': ['#908C8C', '#FFFFFF', '#8000FF', '#0000FF', '#00EAEA', '#00FF00', '#FFFF00', '#FF9933',
+                           '#FF0000'],
+               'link': {'bandwidth': 1000, 'width': 5}}
+        for node in range(self.nodes):
+            x, y = self.node_xy(node)
+            cfg['node-' + str(node + 1)] = {'name': 'host-{}'.format(node), 'label': 'H{}'.format(node),
+                                             'icon': 'Router64.png', 'x': x, 'y': y}
+        for link in self.links:
+            cfg['link-' + link['linkid']] = {'node1': 'node-' + str(link['node1'] + 1),
+                                             'node2': 'node-' + str(link['node2'] + 1),
+                                             'name1': '', 'name2': '', 'hostname': link['hostname'],
+                                             'itemin': link['itemin'], 'itemout': link['itemout']}
+        return cfg
+
+
+class StubException(Exception):
+    def __init__(self, message, code=-32602, data=''):
+        self.message = message
+        self.code = code
+        self.data = data
+
+
+class ZabbixStub(object):
+    """ JSON-RPC methods of Zabbix API on StubData """
+
+    def __init__(self, data: StubData, latency=0.0):
+        self.data = data
+        self.latency = latency
+        self.calls = Counter()
+        self.sessions = set()
+        self.lock = threading.Lock()
+
+    def expire(self):
+        """ Terminate all sessions, like Zabbix after session lifetime """
+        with self.lock:
+            self.sessions.clear()
+
+    @staticmethod
+    def _list(value):
+        if value is None:
+            return None
+        if isinstance(value, (list, tuple, set)):
+            return [str(elem) for elem in value]
+        return [str(value)]
+
+    @staticmethod
+    def _output(objs, output, extra=()):
+        if isinstance(output, list):
+            fields = set(output) | set(extra)
+            return [{key: value for key, value in obj.items() if key in fields} for obj in objs]
+        return [dict(obj) for obj in objs]
+
+    @classmethod
+    def _filter(cls, objs, params, idfield, idparam):
+        ids = cls._list(params.get(idparam))
+        if ids is not None:
+            ids = set(ids)
+            objs = [obj for obj in objs if obj[idfield] in ids]
+        for field, value in (params.get('filter') or {}).items():
+            values = set(cls._list(value))
+            objs = [obj for obj in objs if obj.get(field) in values]
+        return objs
+
+    def call(self, method, params, auth=None):
+        with self.lock:
+            self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if auth is not None and method not in ('user.login', 'apiinfo.version') and auth not in self.sessions:
+            raise StubException('Invalid params.', data='Session terminated, re-login, please.')
+        try:
+            handler = getattr(self, method.replace('.', '_'))
+        except AttributeError:
+            raise StubException('Method not found: {}'.format(method), code=-32601)
+        return handler(params)
+
+    def user_login(self, params):
+        with self.lock:
+            token = 'stubtoken{}'.format(self.calls['user.login'])
+            self.sessions.add(token)
+        return token
+
+    def user_logout(self, params):
+        return True
+
+    def apiinfo_version(self, params):
+        return '3.4.0'
+
+    def host_get(self, params):
+        objs = self._filter(self.data.hosts.values(), params, 'hostid', 'hostids')
+        return self._output(objs, params.get('output'))
+
+    def item_get(self, params):
+        objs = self._filter(self.data.items.values(), params, 'itemid', 'itemids')
+        hostids = self._list(params.get('hostids'))
+        if hostids is not None:
+            hostids = set(hostids)
+            objs = [obj for obj in objs if obj['hostid'] in hostids]
+        return self._output(objs, params.get('output'))
+
+    def hostgroup_get(self, params):
+        groups = [{'groupid': groupid, 'name': name} for groupid, name in self.data.groups.items()]
+        return self._output(self._filter(groups, params, 'groupid', 'groupids'), params.get('output'))
+
+    def trigger_get(self, params):
+        triggers = [{'triggerid': triggerid, 'description': name} for triggerid, name in self.data.triggers.items()]
+        return self._output(self._filter(triggers, params, 'triggerid', 'triggerids'), params.get('output'))
+
+    def map_get(self, params):
+        objs = self._filter(self.data.maps.values(), params, 'sysmapid', 'sysmapids')
+        extra = [field for param, field in (('selectSelements', 'selements'), ('selectLinks', 'links'))
+                 if param in params]
+        if 'output' not in params:
+            params['output'] = ['sysmapid', 'name', 'width', 'height']
+        return self._output(objs, params['output'], extra=extra)
+
+    def image_get(self, params):
+        objs = self._filter(self.data.images.values(), params, 'imageid', 'imageids')
+        objs = self._output(objs, params.get('output'), extra=('image',) if params.get('select_image') else ())
+        if not params.get('select_image') and not isinstance(params.get('output'), list):
+            for obj in objs:
+                obj.pop('image')
+        return objs
+
+    def image_create(self, params):
+        with self.lock:
+            imageid = str(max(int(imageid) for imageid in self.data.images) + 1)
+            self.data.images[imageid] = {'imageid': imageid, 'name': params['name'],
+                                         'imagetype': str(params.get('imagetype', 1)), 'image': params['image']}
+        return {'imageids': [imageid]}
+
+    def image_update(self, params):
+        imageid = str(params['imageid'])
+        if imageid not in self.data.images:
+            raise StubException('No permissions to referred object or it does not exist!')
+        self.data.images[imageid]['image'] = params.get('image', self.data.images[imageid]['image'])
+        return {'imageids': [imageid]}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        reply = {'jsonrpc': '2.0', 'id': request.get('id')}
+        try:
+            reply['result'] = self.server.stub.call(request['method'], request.get('params') or {},
+                                                   auth=request.get('auth'))
+        except StubException as exc:
+            reply['error'] = {'code': exc.code, 'message': exc.message, 'data': exc.data}
+        body = json.dumps(reply).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json-rpc')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, log_format, *args):
+        log.debug(log_format, *args)
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """ HTTP server for ZabbixStub, url is http://host:port without /api_jsonrpc.php """
+    daemon_threads = True
+
+    def __init__(self, stub: ZabbixStub, host='127.0.0.1', port=0):
+        self.stub = stub
+        super().__init__((host, port), StubHandler)
+        self.url = 'http://{}:{}'.format(*self.server_address[:2])
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        log.debug('Zabbix stub started %s', self.url)
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline Zabbix API stand-in')
+    parser.add_argument('--links', type=int, default=100, help='Number of links in generated map')
+    parser.add_argument('--name', type=str, default='bench', help='Generated map name')
+    parser.add_argument('--latency', type=float, default=0.0, help='Delay of every request, seconds')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Listen address')
+    parser.add_argument('--port', type=int, default=8080, help='Listen port')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = StubServer(ZabbixStub(StubData(links=args.links, name=args.name), latency=args.latency),
+                        host=args.host, port=args.port)
+    print('Zabbix stub: {}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()